@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+from xml.sax.saxutils import escape
+
+'''
+generate_wxr - writes a synthetic WordPress export (WXR) for benchmarking
+
+The export is written item by item, so very large files can be generated
+without holding them in memory. The same arguments and seed always give
+the same file.
+
+'''
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua enim '
+         'ad minim veniam quis nostrud exercitation ullamco laboris nisi '
+         'aliquip ex ea commodo consequat duis aute irure in reprehenderit '
+         'voluptate velit esse cillum fugiat nulla pariatur').split()
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8" ?>
+<rss version="2.0"
+    xmlns:excerpt="http://wordpress.org/export/1.2/excerpt/"
+    xmlns:content="http://purl.org/rss/1.0/modules/content/"
+    xmlns:wfw="http://wellformedweb.org/CommentAPI/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:wp="http://wordpress.org/export/1.2/">
+<channel>
+    <title>{title}</title>
+    <link>{link}</link>
+    <description>Synthetic export for benchmarking exitwp</description>
+    <wp:wxr_version>1.2</wp:wxr_version>
+'''
+
+FOOTER = '''</channel>
+</rss>
+'''
+
+
+def cdata(text):
+    return '<![CDATA[' + text.replace(']]>', ']]]]><![CDATA[>') + ']]>'
+
+
+class Generator:
+
+    def __init__(self, posts=1000, pages=50, depth=3, comments=5, images=2,
+                 body_size=4000, link='http://myoldblog.com',
+                 image_host='http://127.0.0.1:8000', seed=1):
+        self.posts = posts
+        self.pages = pages
+        self.depth = depth
+        self.comments = comments
+        self.images = images
+        self.body_size = body_size
+        self.link = link
+        self.image_host = image_host
+        self.random = random.Random(seed)
+        self.next_id = 1
+
+    def sentence(self, words=12):
+        text = ' '.join(self.random.choice(WORDS) for _ in range(words))
+        return text[0].upper() + text[1:] + '.'
+
+    def body(self, wp_id):
+        parts = []
+        size = 0
+        image = 0
+        while size < self.body_size or image < self.images:
+            kind = self.random.random()
+            if image < self.images and (kind < 0.2 or size >= self.body_size):
+                parts.append(
+                    f'<p><a href="{self.image_host}/wp-content/uploads/{wp_id}-{image}.jpg">'
+                    f'<img class="alignnone size-medium" '
+                    f'src="{self.image_host}/wp-content/uploads/{wp_id}-{image}-300x200.jpg" '
+                    f'alt="{self.sentence(3)}" width="300" height="200" /></a></p>')
+                image += 1
+            elif kind < 0.3:
+                parts.append(f'<h2>{self.sentence(4)}</h2>')
+            elif kind < 0.4:
+                items = ''.join(f'<li>{self.sentence(6)}</li>' for _ in range(4))
+                parts.append(f'<ul>{items}</ul>')
+            elif kind < 0.45:
+                rows = ''.join(f'<tr><td>{self.sentence(2)}</td><td>{self.random.randint(1, 999)}</td></tr>'
+                               for _ in range(5))
+                parts.append(f'<table>{rows}</table>')
+            elif kind < 0.5:
+                parts.append(f'[caption id="attachment_{wp_id}"]{self.sentence(5)}[/caption]')
+            elif kind < 0.55:
+                parts.append(f'<pre>{escape(self.sentence(8))}</pre>')
+            else:
+                link = f'<a href="{self.link}/?p={self.random.randint(1, self.next_id)}">{self.sentence(2)}</a>'
+                parts.append(f'<p>{self.sentence()} <strong>{self.sentence(3)}</strong> '
+                             f'{link}<br />\n{self.sentence()}</p>')
+            size += len(parts[-1])
+        return '\n'.join(parts)
+
+    def item(self, post_type, parent='0', comments=0):
+        wp_id = self.next_id
+        self.next_id += 1
+        title = self.sentence(5)[:-1]
+        slug = f'{post_type}-{wp_id}'
+        date = '20{:02d}-{:02d}-{:02d} {:02d}:{:02d}:00'.format(
+            self.random.randint(5, 24), self.random.randint(1, 12),
+            self.random.randint(1, 28), self.random.randint(0, 23),
+            self.random.randint(0, 59))
+        out = [f'''    <item>
+        <title>{escape(title)}</title>
+        <link>{self.link}/{slug}/</link>
+        <dc:creator>{cdata('admin')}</dc:creator>
+        <guid isPermaLink="false">{self.link}/?p={wp_id}</guid>
+        <content:encoded>{cdata(self.body(wp_id))}</content:encoded>
+        <wp:post_id>{wp_id}</wp:post_id>
+        <wp:post_date>{date}</wp:post_date>
+        <wp:post_date_gmt>{date}</wp:post_date_gmt>
+        <wp:comment_status>open</wp:comment_status>
+        <wp:post_name>{slug}</wp:post_name>
+        <wp:status>{'draft' if self.random.random() < 0.05 else 'publish'}</wp:status>
+        <wp:post_parent>{parent}</wp:post_parent>
+        <wp:post_type>{post_type}</wp:post_type>
+        <category domain="category" nicename="cat-{wp_id % 7}">{cdata(f'Category {wp_id % 7}')}</category>
+        <category domain="post_tag" nicename="tag-{wp_id % 13}">{cdata(f'Tag {wp_id % 13}')}</category>
+''']
+        first_comment = wp_id * 1000
+        for n in range(comments):
+            comment_parent = first_comment + self.random.randrange(n) if n and self.random.random() < 0.4 else 0
+            out.append(f'''        <wp:comment>
+            <wp:comment_id>{first_comment + n}</wp:comment_id>
+            <wp:comment_author>{cdata(self.sentence(2)[:-1])}</wp:comment_author>
+            <wp:comment_date>{date}</wp:comment_date>
+            <wp:comment_content>{cdata(self.sentence() + chr(10) + self.sentence())}</wp:comment_content>
+            <wp:comment_approved>1</wp:comment_approved>
+            <wp:comment_parent>{comment_parent}</wp:comment_parent>
+        </wp:comment>
+''')
+        out.append('    </item>\n')
+        return wp_id, ''.join(out)
+
+    def write(self, f):
+        f.write(HEADER.format(title='Benchmark Blog', link=self.link))
+        # Pages are nested in chains of `depth` levels; some chains are
+        # written children first, as real exports sometimes do
+        chain = []
+        for n in range(self.pages):
+            parent = chain[-1][0] if chain else '0'
+            chain.append(self.item('page', parent=parent))
+            if len(chain) == self.depth or n == self.pages - 1:
+                if self.random.random() < 0.3:
+                    chain.reverse()
+                for _, text in chain:
+                    f.write(text)
+                chain = []
+        for _ in range(self.posts):
+            f.write(self.item('post', comments=self.comments)[1])
+        f.write(FOOTER)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic WordPress export.')
+    parser.add_argument('output', help='file to write the export to')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--depth', type=int, default=3, help='nesting depth of pages')
+    parser.add_argument('--comments', type=int, default=5, help='comments per post')
+    parser.add_argument('--images', type=int, default=2, help='images per post')
+    parser.add_argument('--body-size', type=int, default=4000,
+                        help='approximate size of a post body in characters')
+    parser.add_argument('--image-host', default='http://127.0.0.1:8000',
+                        help='scheme and host the image URLs point to')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    generator = Generator(args.posts, args.pages, args.depth, args.comments,
+                          args.images, args.body_size,
+                          image_host=args.image_host, seed=args.seed)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        generator.write(f)
+
+
+if __name__ == '__main__':
+    main()
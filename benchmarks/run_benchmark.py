@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+from generate_wxr import Generator
+
+'''
+run_benchmark - times exitwp on a synthetic WordPress export
+
+Generates an export with generate_wxr, serves its images from a local
+HTTP server and times every stage of the conversion on it: XML parsing,
+body_replace, HTML parsing, markdownify, front matter, file writes and
+image downloads, followed by complete runs of exitwp.py. The results are
+written to a JSON report; pass the report of an earlier version with
+--baseline to see what changed.
+
+'''
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Shortcode rules as found in real migration configs
+BODY_REPLACE = {
+    r'\[caption[^\]]*\]': '',
+    r'\[/caption\]': '',
+    r'\[python\]': '{{< highlight python >}}',
+    r'\[/python\]': '{{< /highlight >}}',
+    r'\[code\]': '{{< highlight >}}',
+    r'\[/code\]': '{{< /highlight >}}',
+    '<pre.*?lang="(.*?)".*?>': r'<pre><code class="language-\1">',
+    '&nbsp;': ' ',
+}
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    image_size = 20000
+    latency = 0.0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        # Deterministic content, different for every path
+        seed = hashlib.sha256(self.path.encode('utf-8')).digest()
+        body = (seed * (self.image_size // len(seed) + 1))[:self.image_size]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_image_server(image_size, latency):
+    handler = type('Handler', (ImageHandler,), {'image_size': image_size,
+                                                'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_config(workspace, html_parser):
+    with open(os.path.join(REPO_DIR, 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    config.update({
+        'verbose': False,
+        'wp_exports': os.path.join(workspace, 'exports'),
+        'build_dir': os.path.join(workspace, 'build'),
+        'download_images': True,
+        'html_parser': html_parser,
+        'body_replace': BODY_REPLACE,
+    })
+    config['image_settings']['included_domains'] = ['127.0.0.1']
+    with open(os.path.join(workspace, 'config.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+class Timer:
+
+    def __init__(self):
+        self.stages = {}
+
+    def run(self, name, func, items):
+        start = time.perf_counter()
+        results = [func(item) for item in items]
+        seconds = time.perf_counter() - start
+        self.stages[name] = {
+            'seconds': round(seconds, 4),
+            'count': len(results),
+            'ms_per_item': round(1000 * seconds / len(results), 4) if results else None,
+        }
+        return results
+
+
+def run_stages(workspace, export_path):
+    """Time the conversion stages one by one, in this process."""
+    sys.path.insert(0, REPO_DIR)
+    import exitwp
+    exitwp.configure(exitwp.load_config(os.path.join(workspace, 'config.yaml')))
+
+    timer = Timer()
+    items = timer.run('xml_parse', lambda item: item,
+                      exitwp.parse_wp_xml(export_path)['items'])
+    bodies = timer.run('body_replace', lambda i: exitwp.body_replacer(i['body']), items)
+    soups = timer.run('html_parse', exitwp.parse_html, bodies)
+    image_urls = sorted({img['src'] for soup in soups for img in soup.find_all('img')
+                         if img.get('src') and exitwp.is_valid_image(img['src'])})
+    markdown = timer.run('markdownify', lambda soup: exitwp.html2fmt(soup, 'markdown'), soups)
+    front_matter = timer.run('front_matter', exitwp.render_front_matter, items)
+
+    out_dir = os.path.join(workspace, 'stages')
+    os.makedirs(out_dir)
+
+    def write(n):
+        exitwp.write_output(os.path.join(out_dir, f'{n}.md'), front_matter[n] + markdown[n])
+    timer.run('file_write', write, range(len(items)))
+
+    downloader = exitwp.ImageDownloader()
+    futures = []
+
+    def download(n):
+        url = image_urls[n]
+        futures.append(downloader.submit(url, os.path.join(out_dir, f'{n}.jpg')))
+    # Downloads overlap, so the stage is timed until the last one finished
+    start = time.perf_counter()
+    timer.run('image_download', download, range(len(image_urls)))
+    failures = sum(not future.result() for future in futures)
+    seconds = time.perf_counter() - start
+    downloader.shutdown()
+    timer.stages['image_download'].update({
+        'seconds': round(seconds, 4),
+        'ms_per_item': round(1000 * seconds / len(image_urls), 4) if image_urls else None,
+        'failures': failures,
+    })
+    return timer.stages
+
+
+def run_exitwp(workspace, name, args, clean=True):
+    """Time a complete run of exitwp.py in a separate process."""
+    if clean:
+        shutil.rmtree(os.path.join(workspace, 'build'), ignore_errors=True)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'exitwp.py')] + args,
+                   cwd=workspace, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    return name, {
+        'args': args,
+        'seconds': round(seconds, 4),
+        # ru_maxrss is in kilobytes on Linux, the largest of all runs so far
+        'peak_rss_mb_so_far': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    rows = [(name, stage['seconds']) for name, stage in report['stages'].items()]
+    rows += [('run: ' + name, run['seconds']) for name, run in report['runs'].items()]
+    old = {}
+    if baseline is not None:
+        old = {name: stage['seconds'] for name, stage in baseline['stages'].items()}
+        old.update({'run: ' + name: run['seconds'] for name, run in baseline['runs'].items()})
+    print(f"{'stage':<28}{'seconds':>10}{'baseline':>10}{'change':>9}")
+    for name, seconds in rows:
+        line = f'{name:<28}{seconds:>10.3f}'
+        if old.get(name):
+            line += f'{old[name]:>10.3f}{100 * (seconds - old[name]) / old[name]:>+8.1f}%'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark exitwp on a synthetic export.')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--depth', type=int, default=3, help='nesting depth of pages')
+    parser.add_argument('--comments', type=int, default=5, help='comments per post')
+    parser.add_argument('--images', type=int, default=2, help='images per post')
+    parser.add_argument('--body-size', type=int, default=4000,
+                        help='approximate size of a post body in characters')
+    parser.add_argument('--image-size', type=int, default=20000,
+                        help='size in bytes of every served image')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the image server waits before answering')
+    parser.add_argument('--html-parser', default='html.parser')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='worker processes for the parallel run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark-report.json',
+                        help='file to write the JSON report to')
+    parser.add_argument('--baseline', help='earlier report to compare with')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the workspace with the export and output')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    server = start_image_server(args.image_size, args.latency)
+    workspace = tempfile.mkdtemp(prefix='exitwp-benchmark-')
+    try:
+        os.makedirs(os.path.join(workspace, 'exports'))
+        export_path = os.path.join(workspace, 'exports', 'export.xml')
+        generator = Generator(args.posts, args.pages, args.depth, args.comments,
+                              args.images, args.body_size,
+                              image_host='http://127.0.0.1:%d' % server.server_address[1],
+                              seed=args.seed)
+        with open(export_path, 'w', encoding='utf-8') as f:
+            generator.write(f)
+        write_config(workspace, args.html_parser)
+
+        runs = dict([
+            run_exitwp(workspace, 'serial', ['--force']),
+            run_exitwp(workspace, 'parallel', ['--force', '--jobs', str(args.jobs)]),
+            run_exitwp(workspace, 'unchanged_rerun', [], clean=False),
+        ])
+        stages = run_stages(workspace, export_path)
+
+        report = {
+            'exitwp_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {key: value for key, value in vars(args).items()
+                           if key not in ('output', 'baseline', 'keep')},
+            'export_bytes': os.path.getsize(export_path),
+            'stages': stages,
+            'runs': runs,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print_report(report, baseline)
+        print(f'\nreport written to {output}')
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f'workspace kept in {workspace}')
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
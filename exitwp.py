@@ -1,57 +1,200 @@
 #!/usr/bin/env python3
 
-import codecs
+import argparse
+import bz2
+import copy
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import lzma
+import math
+import multiprocessing
 import os
 import re
+import shutil
 import sys
+import threading
+import time
 import urllib.parse
-from datetime import datetime, timedelta, tzinfo
+import urllib.request
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone, tzinfo
 from glob import glob
-from urllib.request import urlretrieve
+from html import unescape
 from urllib.parse import urljoin, urlparse
-from xml.etree.ElementTree import ElementTree, TreeBuilder, XMLParser
+from xml.etree.ElementTree import iterparse
 from urllib.error import HTTPError, URLError
-import socket
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+import sqlite3
 
-import yaml
-from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+# PyYAML, Beautiful Soup and markdownify are imported when a stage needs
+# them, so importing exitwp as a library stays cheap.
 
 '''
 exitwp - Wordpress xml exports to Hugo blog format conversion
 
 Tested with Wordpress 3.3.1 and hugo v0.131.0
 
+Run it as a script, or call convert() to use it as a library.
+
 '''
 ######################################################
 # Configration
 ######################################################
-config = yaml.safe_load(open('config.yaml', 'r'))
-wp_exports = config['wp_exports']
-build_dir = config['build_dir']
-download_images = config['download_images']
-include_comments = config['include_comments']
-target_format = config['target_format']
-taxonomy_filter = set(config['taxonomies']['filter'])
-taxonomy_entry_filter = config['taxonomies']['entry_filter']
-taxonomy_name_mapping = config['taxonomies']['name_mapping']
-# NOTE: categories label in the taxonomy is overwritten by the tags_label below!
-tags_label = config.get('tags_label', 'categories')
-item_type_filter = set(config['item_type_filter'])
-item_field_filter = config['item_field_filter']
-date_fmt = config['date_format']
-body_replace = config['body_replace']
-verbose = config['verbose']
-
-image_config = config.get('image_settings', {})
-EXCLUDED_URL_PARTS = image_config.get('excluded_url_parts', [])
-INCLUDED_DOMAINS = image_config.get('included_domains', [])
-DEFAULT_IMAGE_VALIDITY = image_config.get('default_image_validity', True)
-IMAGE_NOT_FOUND_ICON = image_config.get('not_found_icon', '/icons/question-warning.svg')
-DEFAULT_DOWNLOAD_TIMEOUT = image_config.get('download_timeout', 3)
-
-# Global dictionary to track image sources and their local filenames
-image_sources = {}
+# The settings are read from a config dict (see config.yaml) by
+# configure(); convert() calls it for every conversion.
+config = None
+verbose = False
+
+def load_config(path='config.yaml'):
+    import yaml
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+def configure(new_config):
+    global config, wp_exports, build_dir, download_images, include_comments
+    global target_format, taxonomy_filter, taxonomy_entry_filter
+    global taxonomy_name_mapping, tags_label, item_type_filter
+    global item_field_filter, date_fmt, body_replace, html_parser
+    global front_matter_format, comments_output, rewrite_links, verbose, image_config
+    global body_replacer, approved_comments_only
+    global EXCLUDED_URL_PARTS, INCLUDED_DOMAINS, DEFAULT_IMAGE_VALIDITY
+    global IMAGE_NOT_FOUND_ICON, DEFAULT_DOWNLOAD_TIMEOUT, DOWNLOAD_WORKERS
+    global DOWNLOAD_PER_HOST, IMAGE_CACHE_DIR, IMAGE_CACHE_REVALIDATE
+    global DOWNLOAD_RETRIES, RETRY_BACKOFF, CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET
+    global CONVERSION_CACHE_PATH, CONVERSION_CACHE_SIZE, IMAGE_OPTIMIZE, IMAGE_SRCSET
+    global DOWNLOAD_LINKED_IMAGES
+    global conversion_cache, conversion_options
+    config = new_config
+    wp_exports = config['wp_exports']
+    build_dir = config['build_dir']
+    download_images = config['download_images']
+    include_comments = config['include_comments']
+    target_format = config['target_format']
+    taxonomy_filter = set(config['taxonomies']['filter'])
+    taxonomy_entry_filter = config['taxonomies']['entry_filter']
+    taxonomy_name_mapping = config['taxonomies']['name_mapping']
+    # NOTE: categories label in the taxonomy is overwritten by the tags_label below!
+    tags_label = config.get('tags_label', 'categories')
+    item_type_filter = set(config['item_type_filter'])
+    item_field_filter = config['item_field_filter']
+    date_fmt = config['date_format']
+    body_replace = config['body_replace']
+    html_parser = config.get('html_parser', 'html.parser')
+    front_matter_format = config.get('front_matter_format', 'yaml')
+    comments_output = config.get('comments_output', 'inline')
+    approved_comments_only = config.get('approved_comments_only', False)
+    rewrite_links = config.get('rewrite_links', True)
+    verbose = config['verbose']
+
+    image_config = config.get('image_settings', {})
+    EXCLUDED_URL_PARTS = image_config.get('excluded_url_parts', [])
+    INCLUDED_DOMAINS = image_config.get('included_domains', [])
+    DEFAULT_IMAGE_VALIDITY = image_config.get('default_image_validity', True)
+    IMAGE_NOT_FOUND_ICON = image_config.get('not_found_icon', '/icons/question-warning.svg')
+    DEFAULT_DOWNLOAD_TIMEOUT = image_config.get('download_timeout', 3)
+    DOWNLOAD_WORKERS = image_config.get('download_workers', 8)
+    DOWNLOAD_PER_HOST = image_config.get('download_per_host', 4)
+    DOWNLOAD_RETRIES = image_config.get('download_retries', 3)
+    RETRY_BACKOFF = image_config.get('retry_backoff', 0.5)
+    CIRCUIT_BREAKER_FAILURES = image_config.get('circuit_breaker_failures', 5)
+    CIRCUIT_BREAKER_RESET = image_config.get('circuit_breaker_reset', 60)
+    IMAGE_CACHE_DIR = image_config.get('cache_dir', os.path.join(build_dir, 'image-cache'))
+    IMAGE_CACHE_REVALIDATE = image_config.get('cache_revalidate', False)
+    IMAGE_OPTIMIZE = image_optimize_options(image_config.get('optimize'))
+    DOWNLOAD_LINKED_IMAGES = image_config.get('download_linked_images', False)
+    # srcset attributes only exist in html; markdown has no syntax for them
+    IMAGE_SRCSET = bool(IMAGE_OPTIMIZE and IMAGE_OPTIMIZE['srcset_widths']
+                        and target_format == 'html')
+    CONVERSION_CACHE_PATH = config.get('conversion_cache',
+                                       os.path.join(build_dir, 'conversion-cache.sqlite3'))
+    CONVERSION_CACHE_SIZE = config.get('conversion_cache_size', 256) * 1024 * 1024
+
+    body_replacer = BodyReplacer(body_replace or {})
+    conversion_cache = None
+    conversion_options = None
+
+def check_config(config):
+    """Raise ValueError for settings that would only fail halfway through."""
+    front_matter_format = config.get('front_matter_format', 'yaml')
+    if front_matter_format not in FRONT_MATTER_WRITERS:
+        raise ValueError(f"Unknown front_matter_format '{front_matter_format}', "
+                         f"use one of: {', '.join(FRONT_MATTER_WRITERS)}")
+    if config.get('comments_output', 'inline') not in ('inline', 'data'):
+        raise ValueError(f"Unknown comments_output '{config['comments_output']}', "
+                         f"use inline or data")
+    parser = config.get('html_parser', 'html.parser')
+    from bs4.builder import builder_registry
+    if builder_registry.lookup(parser) is None:
+        if parser in ('lxml', 'html5lib'):
+            raise ValueError(f"html_parser {parser} is not installed, install it with "
+                             f"'pip3 install {parser}'")
+        raise ValueError(f"Unknown html_parser '{parser}', use html.parser, lxml or html5lib")
+    optimize = image_optimize_options(config.get('image_settings', {}).get('optimize'))
+    if optimize is not None and config['download_images']:
+        if optimize['format'] not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format '{optimize['format']}', "
+                             f"use one of: {', '.join(IMAGE_FORMATS)}")
+        try:
+            from PIL import Image
+        except ImportError:
+            raise ValueError("Image optimization needs Pillow, install it with "
+                             "'pip3 install Pillow'")
+        Image.init()
+        pil_format = IMAGE_FORMATS[optimize['format']][0]
+        if pil_format is not None and pil_format not in Image.SAVE:
+            raise ValueError(f"This Pillow cannot write {optimize['format']} images")
+
+def image_optimize_options(options):
+    """The image_settings optimize options with their defaults, None if
+    optimization is off."""
+    if not options or not options.get('enabled'):
+        return None
+    return {**IMAGE_OPTIMIZE_DEFAULTS, **options}
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+# Inline (data:) and FTP images are fetched with urlopen, without pooling
+# or caching
+URLOPEN_SCHEMES = ('data', 'ftp')
+# Download outcomes that leave an image missing: a failed request, a host
+# the circuit breaker has given up on for now, or a URL that failed in an
+# earlier run
+FAILED_OUTCOMES = ('failed', 'circuit_open', 'known_failed')
+# Rendered items that may wait for their image downloads at the same time
+MAX_DOWNLOADING_ITEMS = 256
+# Parsed items an export parsed ahead may hold before it waits
+FEED_QUEUE_SIZE = 64
+# Worker processes are started fresh rather than forked: a fork copies the
+# locks of the download threads in whatever state they are, and can hang
+PROCESS_CONTEXT = multiprocessing.get_context('spawn')
+
+IMAGE_OPTIMIZE_DEFAULTS = {
+    'enabled': False,
+    'max_width': 1920,
+    'max_height': 1920,
+    'format': 'webp',
+    'quality': 80,
+    'strip_metadata': True,
+    'srcset_widths': [],
+    'workers': 0,
+}
+# Pillow format and file extension of the optimized images; keep stays
+# with the format the image came in
+IMAGE_FORMATS = {
+    'keep': (None, None),
+    'webp': ('WEBP', '.webp'),
+    'avif': ('AVIF', '.avif'),
+    'jpeg': ('JPEG', '.jpg'),
+}
+# Other images, like GIF and SVG, are used as downloaded
+OPTIMIZABLE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff'}
 
 # Time definitions
 ZERO = timedelta(0)
@@ -62,11 +205,6 @@ def log(msg):
     if verbose:
         print(msg)
 
-if include_comments:
-    log('Comments will be included in the export.')
-else:
-    log('Comments will not be included in the export.')
-
 # UTC support
 class UTC(tzinfo):
     """UTC."""
@@ -91,21 +229,231 @@ class CET(tzinfo):
     def dst(self, dt):
         return timedelta(0)
 
-class ns_tracker_tree_builder(TreeBuilder):
 
-    def __init__(self):
-        TreeBuilder.__init__(self)
-        self.namespaces = {}
+class Stats:
+    """Wall time and call counts per stage, image download metrics per
+    host and the slowest items of a run, for --profile and --stats-json.
+
+    Stages that run in worker processes are timed there and added from
+    the main process, so their seconds are summed over all workers.
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, slowest=10):
+        self.started = time.perf_counter()
+        self.slowest = slowest
+        self.lock = threading.Lock()
+        self.stages = {}     # stage -> [calls, seconds]
+        self.items = []      # heap of the slowest (seconds, n, item summary)
+        self.counted = 0
+        self.downloads = {}  # host -> {outcome counts, bytes, latencies}
 
-    def start_ns(self, prefix, uri):
-        self.namespaces[prefix] = '{' + uri + '}'
+    def add(self, stage, seconds, calls=1):
+        with self.lock:
+            entry = self.stages.setdefault(stage, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
 
-def html2fmt(html, target_format):
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add_item(self, i, seconds):
+        if not self.slowest:
+            return
+        summary = {'wp_id': i['wp_id'], 'type': i['type'], 'title': i['title'],
+                   'body_bytes': i['body_bytes'] or 0,
+                   'seconds': round(seconds, 4)}
+        with self.lock:
+            self.counted += 1
+            entry = (seconds, self.counted, summary)
+            if len(self.items) < self.slowest:
+                heapq.heappush(self.items, entry)
+            else:
+                heapq.heappushpop(self.items, entry)
+
+    def add_download(self, host, outcome, seconds, size=0, retries=0):
+        with self.lock:
+            entry = self.downloads.setdefault(host, {'bytes': 0, 'retries': 0, 'latencies': []})
+            entry[outcome] = entry.get(outcome, 0) + 1
+            entry['bytes'] += size
+            entry['retries'] += retries
+            if outcome in ('downloaded', 'not_modified', 'failed'):
+                entry['latencies'].append(seconds)
+
+    @classmethod
+    def percentiles(cls, values):
+        values = sorted(values)
+        result = {f'p{p}': round(1000 * values[max(0, math.ceil(p * len(values) / 100) - 1)], 1)
+                  for p in cls.PERCENTILES}
+        result['max'] = round(1000 * values[-1], 1)
+        return result
+
+    def report(self):
+        hosts = {}
+        for host, entry in sorted(self.downloads.items()):
+            hosts[host] = {key: value for key, value in entry.items() if key != 'latencies'}
+            if entry['latencies']:
+                hosts[host]['latency_ms'] = self.percentiles(entry['latencies'])
+        latencies = [s for entry in self.downloads.values() for s in entry['latencies']]
+        hits = self.stages.get('cache_hit', [0])[0]
+        misses = self.stages.get('cache_miss', [0])[0]
+        return {
+            'wall_seconds': round(time.perf_counter() - self.started, 3),
+            'conversion_cache': {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+            },
+            'stages': {stage: {'calls': calls, 'seconds': round(seconds, 4)}
+                       for stage, (calls, seconds) in self.stages.items()},
+            'downloads': {
+                'bytes': sum(entry['bytes'] for entry in self.downloads.values()),
+                'latency_ms': self.percentiles(latencies) if latencies else None,
+                'hosts': hosts,
+            },
+            'slowest_items': [summary for _, _, summary in sorted(self.items, reverse=True)],
+        }
+
+    def print_report(self, report=None):
+        report = report or self.report()
+        print(f"profile (wall time {report['wall_seconds']:.2f} s)\n")
+        print(f"  {'stage':<16}{'calls':>8}{'seconds':>10}{'ms/call':>10}")
+        for stage, entry in report['stages'].items():
+            print(f"  {stage:<16}{entry['calls']:>8}{entry['seconds']:>10.3f}"
+                  f"{1000 * entry['seconds'] / entry['calls']:>10.2f}")
+        cache = report['conversion_cache']
+        if cache['hit_rate'] is not None:
+            print(f"\n  conversion cache: {cache['hits']} hits, {cache['misses']} misses "
+                  f"({100 * cache['hit_rate']:.1f}% hit rate)")
+        hosts = report['downloads']['hosts']
+        if hosts:
+            print(f"\n  {'image host':<30}{'fetched':>8}{'cached':>8}{'failed':>8}{'retries':>8}"
+                  f"{'MB':>8}{'p50 ms':>8}{'p90 ms':>8}{'p99 ms':>8}")
+            for host, entry in hosts.items():
+                latency = entry.get('latency_ms') or {}
+                failed = sum(entry.get(outcome, 0) for outcome in FAILED_OUTCOMES)
+                print(f"  {host:<30}{entry.get('downloaded', 0) + entry.get('not_modified', 0):>8}"
+                      f"{entry.get('cached', 0):>8}{failed:>8}{entry['retries']:>8}"
+                      f"{entry['bytes'] / 1e6:>8.2f}" +
+                      ''.join(f"{latency.get(p, ''):>8}" for p in ('p50', 'p90', 'p99')))
+        if report['slowest_items']:
+            print(f"\n  {'slowest items':<16}{'seconds':>10}{'body KB':>10}  title")
+            for item in report['slowest_items']:
+                print(f"  {item['wp_id']:<16}{item['seconds']:>10.3f}"
+                      f"{item['body_bytes'] / 1000:>10.1f}  {item['title']}")
+        print()
+
+stats = Stats()
+
+def lap(timings, stage, start):
+    """Add the time since start to a stage, and return the current time."""
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
+# A key made of plain characters and escaped punctuation matches literally
+LITERAL_PATTERN_RE = re.compile(r'(?:[^.^$*+?{}\[\]\\|()]|\\[^A-Za-z0-9])*\Z')
+
+class BodyReplacer:
+    """The body_replace rules, compiled once.
+
+    The rules are still applied one after the other, with the same result
+    as calling re.sub for each of them. Rules without regex syntax use
+    str.replace, and runs of them that cannot interfere with each other
+    are merged into a single alternation, so the body is scanned once for
+    the whole run.
+    """
+
+    def __init__(self, rules):
+        self.steps = []
+        group = []
+        for key, value in rules.items():
+            if (isinstance(key, str) and isinstance(value, str) and
+                    LITERAL_PATTERN_RE.match(key) and '\\' not in value):
+                key = re.sub(r'\\(.)', r'\1', key, flags=re.S)
+                if not key:
+                    self.add_literals(group)
+                    group = []
+                    self.steps.append(lambda body, value=value: body.replace('', value))
+                elif all(self.independent(group_key, group_value, key)
+                         for group_key, group_value in group):
+                    group.append((key, value))
+                else:
+                    self.add_literals(group)
+                    group = [(key, value)]
+            else:
+                self.add_literals(group)
+                group = []
+                pattern = re.compile(key)
+                self.steps.append(lambda body, pattern=pattern, value=value: pattern.sub(value, body))
+        self.add_literals(group)
+
+    @staticmethod
+    def independent(key, value, later_key):
+        """Whether replacing key with value, and then later_key, gives the
+        same result as replacing both in one pass."""
+        # The first replacement must not create or split up matches of the
+        # second one, and matches of the two keys must never overlap
+        if not value or set(value) & set(later_key):
+            return False
+        if key in later_key or later_key in key:
+            return False
+        return not any(key.endswith(later_key[:n]) or later_key.endswith(key[:n])
+                       for n in range(1, min(len(key), len(later_key))))
+
+    def add_literals(self, group):
+        if len(group) == 1:
+            [(key, value)] = group
+            self.steps.append(lambda body: body.replace(key, value) if key in body else body)
+        elif group:
+            replacements = dict(group)
+            pattern = re.compile('|'.join(re.escape(key) for key, _ in group))
+            self.steps.append(lambda body: pattern.sub(lambda m: replacements[m.group(0)], body))
+
+    def __call__(self, body):
+        for step in self.steps:
+            body = step(body)
+        return body
+
+MARKDOWN_OPTIONS = {'heading_style': 'ATX', 'bullets': '-*+'}
+markdown_converter = None  # created on first use
+
+def parse_html(html):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, html_parser)
+    if html_parser == 'html.parser':
+        # html.parser can leave content inside a void element, e.g. for
+        # '<br>a<br/>b'. Move it behind the element, or markdownify drops
+        # it together with the <br>.
+        filled = [tag for tag in soup.find_all(list(soup.builder.empty_element_tags))
+                  if tag.contents]
+        for tag in filled:
+            for child in reversed(tag.contents):
+                tag.insert_after(child.extract())
+        if filled:
+            soup.smooth()
+    return soup
+
+
+def html2fmt(soup, target_format):
     if target_format == 'html':
-        return html
+        if html_parser != 'html.parser' and soup.body is not None:
+            # lxml and html5lib wrap the body in a complete document
+            return soup.body.decode_contents()
+        return str(soup)
     else:
-        # Use markdownify to convert HTML to Markdown
-        return md(html, heading_style="ATX", bullets="-*+")
+        # Use markdownify to convert the parsed HTML to Markdown
+        global markdown_converter
+        if markdown_converter is None:
+            from markdownify import MarkdownConverter
+            markdown_converter = MarkdownConverter(**MARKDOWN_OPTIONS)
+        return markdown_converter.convert_soup(soup)
 
 def is_valid_image(url):
     # Exclude URLs containing any of the parts in EXCLUDED_URL_PARTS
@@ -125,197 +473,1873 @@ def is_valid_image(url):
     return DEFAULT_IMAGE_VALIDITY
 
 
-def download_image(url, local_path, timeout=DEFAULT_DOWNLOAD_TIMEOUT):
-    if not is_valid_image(url):
-        log(f"Skipping invalid image: {url}")
-        return False
+def save_json(path, data):
+    # Write to a temporary file first, so an interrupted run never leaves
+    # a truncated file behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
 
-    if os.path.exists(local_path):
-        print(f'Image already exists: {local_path}')
-        return False
+
+def place_file(source, path):
+    """Hard link a file to path, or copy it where links are not possible."""
+    part_path = path + '.part'
     try:
-        with urllib.request.urlopen(url, timeout=timeout) as response, open(local_path, 'wb') as out_file:
-            out_file.write(response.read())
+        os.link(source, part_path)
+    except OSError:
+        shutil.copyfile(source, part_path)
+    os.replace(part_path, path)
+
+
+class ImageCache:
+    """On-disk image cache, shared by all runs and export files.
+
+    Images are stored once per content hash under objects/, and
+    manifest.json maps each source URL to the hash of its content and the
+    ETag/Last-Modified headers it was served with. Local copies are hard
+    links to the stored object where the filesystem allows it.
+    """
+
+    SAVE_EVERY = 100
+
+    def __init__(self, cache_dir, revalidate=False):
+        self.cache_dir = cache_dir
+        self.revalidate = revalidate
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        os.makedirs(os.path.join(cache_dir, 'tmp'), exist_ok=True)
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.urls = json.load(f)['urls']
+        except FileNotFoundError:
+            self.urls = {}
+
+    def object_path(self, sha256):
+        return os.path.join(self.cache_dir, 'objects', sha256[:2], sha256)
+
+    def lookup(self, url):
+        entry = self.urls.get(url)
+        if entry is None or not os.path.exists(self.object_path(entry['sha256'])):
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, response):
+        """Stream a response into the cache and return its manifest entry."""
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.cache_dir, 'tmp', uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as out_file:
+                while True:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    out_file.write(chunk)
+            sha256 = digest.hexdigest()
+            object_path = self.object_path(sha256)
+            if os.path.exists(object_path):
+                # Identical bytes are only stored once
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        entry = {
+            'sha256': sha256,
+            'size': size,
+            'etag': response.getheader('ETag'),
+            'last_modified': response.getheader('Last-Modified'),
+        }
+        with self.lock:
+            self.urls[url] = entry
+            self.unsaved += 1
+            save = self.unsaved >= self.SAVE_EVERY
+        if save:
+            self.save()
+        return entry
+
+    def copy_to(self, entry, local_path):
+        place_file(self.object_path(entry['sha256']), local_path)
+
+    def save(self):
+        with self.lock:
+            save_json(self.manifest_path, {'urls': self.urls})
+            self.unsaved = 0
+
+class DownloadJournal:
+    """On-disk record of every image download: pending, done or failed.
+
+    It is kept in SQLite in the build directory and committed every few
+    updates, so a run that is killed leaves an accurate record behind.
+    URLs that failed are not tried again by later runs, unless they retry
+    failed downloads.
+    """
+
+    COMMIT_EVERY = 50
+
+    def __init__(self, path, retry_failed=False):
+        self.retry_failed = retry_failed
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Used from the download threads, always under the lock
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS downloads (url TEXT PRIMARY KEY, '
+                            'path TEXT, state TEXT, attempts INTEGER, error TEXT, '
+                            'updated REAL)')
+        self.failures = dict(self.db.execute(
+            "SELECT url, error FROM downloads WHERE state = 'failed'").fetchall())
+
+    def known_failure(self, url):
+        """Why the URL failed in an earlier run, None to try it."""
+        if self.retry_failed:
+            return None
+        return self.failures.get(url)
+
+    def pending(self):
+        return self.db.execute("SELECT COUNT(*) FROM downloads WHERE state = 'pending'").fetchone()[0]
+
+    def update(self, url, path, state, attempts=0, error=None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)',
+                            (url, path, state, attempts, error, time.time()))
+            self.uncommitted += 1
+            if self.uncommitted >= self.COMMIT_EVERY:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class CircuitBreaker:
+    """Stops downloading from hosts that keep failing.
+
+    After `threshold` failures in a row the circuit of a host opens: its
+    downloads fail at once, without a request, for `reset` seconds. Then
+    one download is let through; if it works the circuit closes again,
+    otherwise it stays open for another `reset` seconds.
+    """
+
+    def __init__(self, threshold, reset):
+        self.threshold = threshold
+        self.reset = reset
+        self.lock = threading.Lock()
+        self.failures = {}   # host -> failures in a row
+        self.opened = {}     # host -> time the circuit opened
+        self.trials = set()  # hosts with a trial download running
+
+    def allow(self, host):
+        with self.lock:
+            if host not in self.opened:
+                return True
+            if host in self.trials or time.monotonic() - self.opened[host] < self.reset:
+                return False
+            self.trials.add(host)
+            return True
+
+    def record(self, host, ok):
+        with self.lock:
+            self.trials.discard(host)
+            if ok:
+                self.failures.pop(host, None)
+                self.opened.pop(host, None)
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.threshold and (self.failures[host] >= self.threshold or host in self.opened):
+                if host not in self.opened:
+                    print(f'{host} failed {self.failures[host]} times in a row, '
+                          f'not downloading from it for {self.reset} seconds')
+                self.opened[host] = time.monotonic()
+
+
+class ImageDownloader:
+    """Downloads images concurrently on a thread pool.
+
+    At most `per_host` downloads run against the same host at a time, the
+    rest wait in a queue for that host. Connections are kept alive and
+    reused per host, and responses are streamed to disk in chunks. With an
+    ImageCache, images fetched before are not downloaded again.
+
+    Timeouts, connection errors and 5xx/429 responses are retried with
+    exponential backoff, and a CircuitBreaker gives up on hosts that keep
+    failing. With a DownloadJournal, the state of every download is
+    recorded on disk.
+    """
+
+    def __init__(self, workers=None, per_host=None, timeout=None, cache=None, journal=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers or DOWNLOAD_WORKERS)
+        self.cache = cache
+        self.journal = journal
+        self.retries = DOWNLOAD_RETRIES
+        self.backoff = RETRY_BACKOFF
+        self.breaker = CircuitBreaker(CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET)
+        self.per_host = per_host or DOWNLOAD_PER_HOST
+        self.timeout = timeout or DEFAULT_DOWNLOAD_TIMEOUT
+        self.lock = threading.Lock()
+        self.downloads = {}    # local_path -> Future
+        self.host_queues = {}  # host -> deque of waiting downloads
+        self.host_active = {}  # host -> number of running downloads
+        self.connections = {}  # (scheme, host) -> idle connections
+
+    def submit(self, url, local_path):
+        """Queue a download, the Future resolves to True on success."""
+        future = self.downloads.get(local_path)
+        if future is not None:
+            return future
+        future = self.downloads[local_path] = Future()
+        if self.journal is not None:
+            self.journal.update(url, local_path, 'pending')
+        host = urlparse(url).netloc
+        with self.lock:
+            queue = self.host_queues.setdefault(host, deque())
+            queue.append((url, local_path, future))
+        self._start_next(host)
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown()
+        if self.cache is not None:
+            self.cache.save()
+        if self.journal is not None:
+            self.journal.close()
+        for idle in self.connections.values():
+            for conn in idle:
+                conn.close()
+
+    def _start_next(self, host):
+        with self.lock:
+            queue = self.host_queues[host]
+            if not queue or self.host_active.get(host, 0) >= self.per_host:
+                return
+            self.host_active[host] = self.host_active.get(host, 0) + 1
+            task = queue.popleft()
+        self.executor.submit(self._run, host, *task)
+
+    def _run(self, host, url, local_path, future):
+        try:
+            future.set_result(self.download(url, local_path))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.host_active[host] -= 1
+            self._start_next(host)
+
+    def _get_connection(self, key):
+        with self.lock:
+            idle = self.connections.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host = key
+        conn_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return conn_class(host, timeout=self.timeout), False
+
+    def _release_connection(self, key, conn, response):
+        if response.will_close:
+            conn.close()
+        else:
+            with self.lock:
+                self.connections.setdefault(key, []).append(conn)
+
+    def _open(self, url, headers=None):
+        # Follow redirects like urlopen does, on pooled connections
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                # Not a URLError: those are retried
+                raise ValueError(f'unsupported URL scheme: {parts.scheme}')
+            key = (parts.scheme, parts.netloc)
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+            while True:
+                conn, reused = self._get_connection(key)
+                try:
+                    conn.request('GET', target, headers={'User-Agent': 'exitwp', **(headers or {})})
+                    response = conn.getresponse()
+                    break
+                except (HTTPException, ConnectionError):
+                    conn.close()
+                    # The server may have closed an idle keep-alive connection
+                    if not reused:
+                        raise
+                except BaseException:
+                    conn.close()
+                    raise
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                self._release_connection(key, conn, response)
+                url = urljoin(url, location)
+                continue
+            if not (200 <= response.status < 300 or response.status == 304):
+                conn.close()
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return key, conn, response
+        raise URLError(f'too many redirects: {url}')
+
+    def download(self, url, local_path):
+        start = time.perf_counter()
+        outcome, attempts, error = self._download(url, local_path)
+        size = 0
+        if outcome == 'downloaded':
+            size = os.path.getsize(local_path)
+        stats.add_download(urlparse(url).netloc, outcome, time.perf_counter() - start, size,
+                           retries=max(0, attempts - 1))
+        if self.journal is not None and outcome != 'skipped':
+            state = 'failed' if outcome in FAILED_OUTCOMES else 'done'
+            self.journal.update(url, local_path, state, attempts, error)
+        return outcome in ('downloaded', 'not_modified', 'cached', 'exists')
+
+    def _download(self, url, local_path):
+        # Returns the outcome, the number of requests made and the error
+        if not is_valid_image(url):
+            log(f"Skipping invalid image: {url}")
+            return 'skipped', 0, None
+
+        if os.path.exists(local_path):
+            print(f'Image already exists: {local_path}')
+            return 'exists', 0, None
+        if self.journal is not None:
+            error = self.journal.known_failure(url)
+            if error is not None:
+                log(f"Skipping image that failed before ({error}): {url}")
+                return 'known_failed', 0, error
+        entry = self.cache.lookup(url) if self.cache is not None else None
+        if entry is not None and not self.cache.revalidate:
+            try:
+                self.cache.copy_to(entry, local_path)
+                log(f"Using cached copy of: {url}")
+                return 'cached', 0, None
+            except OSError as e:
+                print(f"Unexpected error when copying {url} from the cache: {str(e)}")
+                return 'failed', 0, str(e)
+
+        host = urlparse(url).netloc
+        attempts, error = 0, None
+        while True:
+            if not self.breaker.allow(host):
+                log(f"Not downloading {url}, {host} is failing")
+                return 'circuit_open', attempts, str(error or f'{host} is failing')
+            attempts += 1
+            try:
+                outcome = self._fetch(url, local_path, entry)
+                self.breaker.record(host, True)
+                return outcome, attempts, None
+            except HTTPError as e:
+                error = e
+                # The host answers, the image is just not there
+                transient = e.code >= 500 or e.code == 429
+                self.breaker.record(host, not transient)
+            except (URLError, HTTPException, OSError) as e:
+                # Timeouts, refused and reset connections, DNS failures
+                error = e
+                transient = True
+                self.breaker.record(host, False)
+            except ValueError as e:
+                # A URL that cannot be downloaded at all
+                print(f"Error downloading {url}: {str(e)}")
+                return 'failed', attempts, str(e)
+            except Exception as e:
+                print(f"Unexpected error when downloading {url}: {str(e)}")
+                return 'failed', attempts, str(e)
+            if not transient or attempts > self.retries:
+                print(f"Error downloading {url}: {str(error)}")
+                return 'failed', attempts, str(error)
+            delay = self.backoff * 2 ** (attempts - 1)
+            log(f"Error downloading {url}: {str(error)}, trying again in {delay:g} s")
+            time.sleep(delay)
+
+    def _fetch(self, url, local_path, entry):
+        part_path = local_path + '.part'
+        if urllib.parse.urlsplit(url).scheme in URLOPEN_SCHEMES:
+            try:
+                with urllib.request.urlopen(url, timeout=self.timeout) as response, \
+                        open(part_path, 'wb') as out_file:
+                    shutil.copyfileobj(response, out_file, DOWNLOAD_CHUNK_SIZE)
+            except BaseException:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            os.replace(part_path, local_path)
+            log(f"Successfully downloaded: {url[:80]}")
+            return 'downloaded'
+        headers = self.cache.conditional_headers(entry) if entry is not None else {}
+        key, conn, response = self._open(url, headers)
+        try:
+            if response.status == 304:
+                response.read()
+            elif self.cache is not None:
+                entry = self.cache.store(url, response)
+            else:
+                with open(part_path, 'wb') as out_file:
+                    while True:
+                        chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        out_file.write(chunk)
+        except BaseException:
+            conn.close()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        self._release_connection(key, conn, response)
+        if response.status == 304:
+            self.cache.copy_to(entry, local_path)
+            log(f"Cached copy still valid: {url}")
+            return 'not_modified'
+        if self.cache is not None:
+            self.cache.copy_to(entry, local_path)
+        else:
+            os.replace(part_path, local_path)
         log(f"Successfully downloaded: {url}")
+        return 'downloaded'
+
+def optimize_image(source_path, target_path, variants, options, cache_dir=None):
+    """Resize and recompress a downloaded image, in a worker process.
+
+    The image is shrunk to fit max_width by max_height, turned the way
+    its EXIF orientation says, and saved in the configured format.
+    variants are (width, path) pairs of smaller copies for srcset; only
+    the ones narrower than the image are made. Results are cached by the
+    hash of the original and the options. Returns the width of the image,
+    the widths of the variants made and the seconds it took.
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    start = time.perf_counter()
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8'))
+    digest.update(data)
+    digest = digest.hexdigest()
+    ext = os.path.splitext(target_path)[1].lower()
+    original = None
+    prepared = None
+
+    def cache_path(width):
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, digest[:2], f'{digest}-{width or "full"}{ext}')
+
+    def prepare():
+        nonlocal original, prepared
+        if prepared is None:
+            try:
+                original = Image.open(io.BytesIO(data))
+            except UnidentifiedImageError:
+                raise ValueError('not an image Pillow can read')
+            prepared = ImageOps.exif_transpose(original)
+        return prepared
+
+    def save(image, path):
+        pil_format = IMAGE_FORMATS[options['format']][0] or original.format
+        transparent = (image.mode in ('RGBA', 'LA', 'PA') or
+                       (image.mode == 'P' and 'transparency' in image.info))
+        mode = 'RGBA' if transparent else 'RGB'
+        if pil_format == 'JPEG' and mode == 'RGBA':
+            # JPEG has no transparency, put the image on white
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA'))
+            image = background
+        elif pil_format in ('JPEG', 'WEBP', 'AVIF') and image.mode != mode:
+            image = image.convert(mode)
+        params = {'quality': options['quality'], 'optimize': True}
+        if pil_format == 'JPEG':
+            params['progressive'] = True
+        if original.info.get('icc_profile'):
+            # The color profile is kept, it changes how the image looks
+            params['icc_profile'] = original.info['icc_profile']
+        if not options['strip_metadata']:
+            params['exif'] = prepared.getexif()
+            if original.info.get('xmp'):
+                params['xmp'] = original.info['xmp']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Other workers may be saving the same cached image
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            image.save(tmp_path, pil_format, **params)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def make(width, path, render):
+        cached = cache_path(width)
+        if cached is None:
+            save(render(), path)
+            return
+        if not os.path.exists(cached):
+            save(render(), cached)
+        place_file(cached, path)
+
+    def full_size():
+        image = prepare()
+        if getattr(original, 'is_animated', False):
+            raise ValueError('animated images are not optimized')
+        image = image.copy()
+        # thumbnail() only ever makes an image smaller
+        image.thumbnail((options['max_width'], options['max_height']), Image.LANCZOS)
+        return image
+
+    cached = cache_path(None)
+    if cached is not None and os.path.exists(cached):
+        place_file(cached, target_path)
+        with Image.open(cached) as image:
+            width, height = image.size
+    else:
+        image = full_size()
+        width, height = image.size
+        make(None, target_path, lambda: image)
+
+    widths = []
+    for variant_width, path in variants:
+        if variant_width >= width:
+            continue
+        size = (variant_width, max(1, round(height * variant_width / width)))
+        make(variant_width, path, lambda: prepare().resize(size, Image.LANCZOS))
+        widths.append(variant_width)
+    return width, widths, time.perf_counter() - start
+
+
+class ImageOptimizer:
+    """Resizes and recompresses downloaded images in a process pool.
+
+    Images are downloaded to a staging directory first, and the optimized
+    image and its srcset variants are written to their place in the blog.
+    An image that cannot be optimized is used as it was downloaded.
+    """
+
+    def __init__(self, options, staging_dir, cache_dir=None):
+        self.options = options
+        self.staging_dir = staging_dir
+        self.cache_dir = cache_dir
+        self.executor = ProcessPoolExecutor(max_workers=options['workers'] or None,
+                                            mp_context=PROCESS_CONTEXT)
+        self.futures = {}  # local_path -> Future
+        self.images = {}   # url -> Future of its first optimized copy
+        # Images made with other options are made again
+        tag_options = {key: value for key, value in options.items() if key != 'workers'}
+        self.tag = hashlib.sha256(json.dumps(tag_options, sort_keys=True)
+                                  .encode('utf-8')).hexdigest()[:12]
+        os.makedirs(staging_dir, exist_ok=True)
+
+    def target_ext(self, file_ext):
+        """The extension of the optimized image, None if it is not optimized."""
+        if file_ext.lower() not in OPTIMIZABLE_EXTENSIONS:
+            return None
+        return IMAGE_FORMATS[self.options['format']][1] or file_ext
+
+    def staging_path(self, url, file_ext):
+        return os.path.join(self.staging_dir,
+                            hashlib.sha256(url.encode('utf-8')).hexdigest() + file_ext)
+
+    def submit(self, url, download, source_path, local_path, variants):
+        """Optimize an image once its download succeeded.
+
+        An image is downloaded and optimized once per URL, and placed at
+        every local_path that uses it. The Future resolves to the width
+        of the image and the widths of the variants made (None and []
+        when the image is used as downloaded), or to False when the
+        download failed.
+        """
+        future = self.futures.get(local_path)
+        if future is not None:
+            return future
+        future = self.futures[local_path] = Future()
+        first = self.images.get(url)
+        if first is None:
+            first = self.images[url] = self._optimize(url, download, source_path,
+                                                      local_path, variants)
+
+        def placed(first):
+            try:
+                result = first.result()
+                if result:
+                    first_path, first_variants, (width, widths) = result
+                    if first_path != local_path:
+                        place_file(first_path, local_path)
+                        for (w, path), (_, first_variant) in zip(variants, first_variants):
+                            if w in widths:
+                                place_file(first_variant, path)
+                    result = width, widths
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        first.add_done_callback(placed)
+        return future
+
+    def _optimize(self, url, download, source_path, local_path, variants):
+        # Resolves to local_path, variants and the (width, widths) of the
+        # optimized image, or to False when the download failed
+        future = Future()
+
+        def optimized(task):
+            # Whatever happens, the Future is resolved, or the items
+            # waiting for the image would wait forever
+            try:
+                try:
+                    width, widths, seconds = task.result()
+                    stats.add('image_optimize', seconds)
+                except Exception as e:
+                    print(f"Could not optimize {url}, using it as downloaded: {e}")
+                    place_file(source_path, local_path)
+                    width, widths = None, []
+                os.remove(source_path)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result((local_path, variants, (width, widths)))
+
+        def downloaded(download):
+            try:
+                if not download.result():
+                    future.set_result(False)
+                    return
+                task = self.executor.submit(optimize_image, source_path, local_path,
+                                            variants, self.options, self.cache_dir)
+                task.add_done_callback(optimized)
+            except BaseException as e:
+                if not future.done():
+                    future.set_exception(e)
+
+        download.add_done_callback(downloaded)
+        return future
+
+    def on_disk(self, local_path, variants):
+        """A resolved Future for an image optimized by an earlier run."""
+        from PIL import Image
+        future = Future()
+        try:
+            with Image.open(local_path) as image:
+                width = image.width
+        except Exception:
+            width = None
+        future.set_result((width, [w for w, path in variants if os.path.exists(path)]))
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def image_srcset(relative_path, width, variants, widths):
+    if width is None:
+        return relative_path
+    srcset = [f'{path} {w}w' for w, path in variants if w in widths]
+    srcset.append(f'{relative_path} {width}w')
+    return ', '.join(srcset)
+
+
+class AttachmentAllocator:
+    """Assigns local file names to image sources without polling the disk.
+
+    Every target directory is listed once. After that, names are handed
+    out from in-memory maps: a source keeps the name it was given before,
+    in this run or an earlier one (`names` is kept in the build manifest),
+    and otherwise gets the first of name.ext, name-1.ext, name-2.ext, ...
+    that no other source uses. With hashed, new names are name-<hash of
+    the source>.ext instead, so runs that each see only part of the items
+    (shards) never give the same name to different sources.
+
+    Optimized images are tagged with the options they were made with
+    (`tags` is kept in the build manifest too). A source keeps its name
+    only while its extension stays the same, and a file with another tag
+    does not count as on disk, so it is made again.
+    """
+
+    def __init__(self, names=None, hashed=False, tags=None, paths=None):
+        self.hashed = hashed
+        self.names = {} if names is None else names  # dir -> {src: name}
+        self.tags = {} if tags is None else tags      # dir -> {src: tag}
+        self.stale = set()  # (dir, name) of files made with other options
+        # src -> path of its first copy, for links to the image; kept in
+        # the build manifest as well, so links lead to the same copy in
+        # every run
+        self.paths = {} if paths is None else paths
+        for target_dir, dir_names in self.names.items():
+            for src, name in dir_names.items():
+                self.paths.setdefault(src, os.path.join(target_dir, name))
+        self.sources = {}   # dir -> {name: src}
+        self.suffixes = {}  # (dir, root, ext) -> next suffix to try
+        self.listings = {}  # dir -> names on disk when first used
+
+    def _open_dir(self, target_dir):
+        if target_dir not in self.listings:
+            os.makedirs(target_dir, exist_ok=True)
+            self.listings[target_dir] = set(os.listdir(target_dir))
+            names = self.names.setdefault(target_dir, {})
+            self.sources[target_dir] = {name: src for src, name in names.items()}
+
+    def allocate(self, target_dir, src, file_root, file_ext, tag=None):
+        self._open_dir(target_dir)
+        names = self.names[target_dir]
+        sources = self.sources[target_dir]
+        tags = self.tags.setdefault(target_dir, {})
+        name = names.get(src)
+        if name is not None and os.path.splitext(name)[1] != file_ext:
+            # The image is saved in another format now, its old file goes
+            self._release(target_dir, src, name)
+        elif name is not None:
+            if tags.get(src) != tag:
+                self.stale.add((target_dir, name))
+                self._tag(tags, src, tag)
+            return name
+        key = (target_dir, file_root, file_ext)
+        name = file_root + file_ext
+        if self.hashed:
+            name = f"{file_root}-{hashlib.sha256(src.encode('utf-8')).hexdigest()[:8]}{file_ext}"
+        elif name in sources:
+            suffix = self.suffixes.get(key, 1)
+            name = f'{file_root}-{suffix}{file_ext}'
+            while name in sources:
+                suffix += 1
+                name = f'{file_root}-{suffix}{file_ext}'
+            self.suffixes[key] = suffix + 1
+        names[src] = name
+        sources[name] = src
+        self._tag(tags, src, tag)
+        self.paths.setdefault(src, os.path.join(target_dir, name))
+        return name
+
+    @staticmethod
+    def _tag(tags, src, tag):
+        if tag is None:
+            tags.pop(src, None)
+        else:
+            tags[src] = tag
+
+    def _release(self, target_dir, src, name):
+        path = os.path.join(target_dir, name)
+        del self.names[target_dir][src]
+        del self.sources[target_dir][name]
+        self.listings[target_dir].discard(name)
+        if self.paths.get(src) == path:
+            del self.paths[src]
+        if os.path.exists(path):
+            os.remove(path)
+
+    def find(self, src):
+        """The path a source was given in this run or an earlier one, or
+        None."""
+        return self.paths.get(src)
+
+    def on_disk(self, target_dir, name):
+        """Whether the file was there before this run, made with the
+        current options."""
+        self._open_dir(target_dir)
+        return name in self.listings[target_dir] and (target_dir, name) not in self.stale
+
+
+# Compressed exports are decompressed while they are parsed
+EXPORT_DECOMPRESSORS = {
+    '.gz': lambda f: gzip.GzipFile(fileobj=f),
+    '.bz2': bz2.BZ2File,
+    '.xz': lzma.LZMAFile,
+}
+EXPORT_PATTERNS = ['*.xml'] + ['*.xml' + ext for ext in EXPORT_DECOMPRESSORS]
+# Large reads, so slow (network) storage is not asked for 16 KB at a time
+EXPORT_READ_BUFFER = 1024 * 1024
+
+
+def find_exports(directory):
+    files = set()
+    for pattern in EXPORT_PATTERNS:
+        files.update(glob(os.path.join(directory, pattern)))
+    return sorted(files)
+
+
+def open_export(file):
+    """Open an export for reading, decompressing .gz, .bz2 and .xz files
+    on the fly."""
+    f = open(file, 'rb', buffering=EXPORT_READ_BUFFER)
+    decompressor = EXPORT_DECOMPRESSORS.get(os.path.splitext(file)[1].lower())
+    if decompressor is None:
+        return f
+    try:
+        return decompressor(f)
+    except BaseException:
+        f.close()
+        raise
+
+
+class Item:
+    """One item of an export.
+
+    Items are slotted records instead of dicts, which matters for exports
+    with 100k items, and they are read like the dicts they used to be:
+    i['title']. Besides the fields of the export, write_hugo keeps the
+    state of an item while it is written in it.
+    """
+
+    FIELDS = ('title', 'link', 'author', 'date', 'slug', 'status', 'type', 'wp_id',
+              'guid', 'parent', 'taxanomies', 'tags', 'body', 'comments')
+    __slots__ = FIELDS + ('selected', 'uid', 'manifest', 'result', 'seconds',
+                          'comments_file', 'body_bytes', 'link_targets')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def fields(self):
+        """The fields read from the export, as a dict."""
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def drop_body(self):
+        # Once rendered, only the size of the body is still needed
+        if self.body is not None:
+            self.body_bytes = len(self.body.encode('utf-8', 'surrogatepass'))
+            self.body = None
+
+
+def gmt_datetime(date):
+    # Post dates are compared as naive GMT datetimes
+    if date is not None and date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+class ItemSelection:
+    """The items a run converts: a shard of them by a hash of their wp_id,
+    a range of post dates (since inclusive, until exclusive) and/or a list
+    of wp_ids. The hash is the same on every machine, so runs of shards
+    (1, N) to (N, N) together convert every item exactly once.
+    """
+
+    def __init__(self, shard=None, since=None, until=None, ids=None):
+        self.shard = shard
+        self.since = gmt_datetime(since)
+        self.until = gmt_datetime(until)
+        self.ids = None if ids is None else {str(wp_id).strip() for wp_id in ids}
+
+    def __bool__(self):
+        # Whether it selects anything less than all items
+        return (self.shard is not None or self.since is not None or
+                self.until is not None or self.ids is not None)
+
+    def __call__(self, i):
+        if self.ids is not None and i['wp_id'] not in self.ids:
+            return False
+        if self.shard is not None:
+            k, n = self.shard
+            digest = hashlib.sha256((i['wp_id'] or '').encode('utf-8')).digest()
+            if int.from_bytes(digest[:8], 'big') % n != k - 1:
+                return False
+        if self.since is not None or self.until is not None:
+            try:
+                date = datetime.strptime(i['date'], date_fmt)
+            except (TypeError, ValueError):
+                return False
+            if self.since is not None and date < self.since:
+                return False
+            if self.until is not None and date >= self.until:
+                return False
         return True
-    except (HTTPError, URLError, socket.timeout) as e:
-        print(f"Error downloading {url}: {str(e)}")
-    except Exception as e:
-        print(f"Unexpected error when downloading {url}: {str(e)}")
-    return False
 
-def parse_wp_xml(file):
-    tree_builder = ns_tracker_tree_builder()
-    parser = XMLParser(target=tree_builder)
-    tree = ElementTree()
-    log('reading: ' + wpe)
-    root = tree.parse(file, parser)
-    ns = tree_builder.namespaces
-    ns[''] = ''
 
-    c = root.find('channel')
+def parse_wp_xml(file, stage='xml_parse', with_comments=None, select=None):
+    log('reading: ' + file)
+    # Namespaces are tracked from the start-ns events, in the same
+    # '{uri}' form the old tree builder collected them in.
+    ns = {'': ''}
+    if with_comments is None:
+        with_comments = include_comments
+    source = open_export(file)
+    events = iterparse(source, events=('start-ns', 'start', 'end'))
+    path = []
+
+    def next_channel_child():
+        # Read on until the next direct child of <channel> is complete
+        for event, elem in events:
+            if event == 'start-ns':
+                prefix, uri = elem
+                ns[prefix] = '{' + uri + '}'
+            elif event == 'start':
+                path.append(elem)
+            else:
+                path.pop()
+                if len(path) == 2:
+                    return path[1], elem
+        return None, None
 
     def parse_header():
+        # The channel header comes before the first <item>, so stop there
+        # and hand that item over to parse_items().
+        header = {}
+        while True:
+            c, elem = next_channel_child()
+            if elem is None or elem.tag == 'item':
+                break
+            if elem.tag in ('title', 'link', 'description') and elem.tag not in header:
+                header[elem.tag] = str(elem.text)
+            c.remove(elem)
+        return header, c, elem
+
+    def parse_comment(c):
+        values = {}
+        for child in c:
+            values.setdefault(child.tag, child.text)
+
+        def cv(tag):
+            return (values.get(ns['wp'] + tag) or '').strip()
+
         return {
-            'title': str(c.find('title').text),
-            'link': str(c.find('link').text),
-            'description': str(c.find('description').text)
+            'id': cv('comment_id'),
+            'parent': cv('comment_parent'),
+            'author': cv('comment_author'),
+            'date': cv('comment_date'),
+            'content': cv('comment_content'),
+            'approved': cv('comment_approved'),
         }
 
-    def parse_items():
-        export_items = []
-        xml_items = c.findall('item')
-        for i in xml_items:
-            taxanomies = i.findall('category')
-            export_taxanomies = {}
-            tags = ['pre-2010']  # New list to store tags
-            for tax in taxanomies:
-                if 'domain' not in tax.attrib:
-                    continue
-                t_domain = str(tax.attrib['domain'])
-                t_entry = str(tax.attrib.get('nicename', tax.text.strip()))
-                if t_domain == 'category':  # If it's a category, add it to tags
-                    tags.append(t_entry)
-                elif (not (t_domain in taxonomy_filter) and
-                      not (t_domain in taxonomy_entry_filter and
-                           taxonomy_entry_filter[t_domain] == t_entry)):
-                    if t_domain not in export_taxanomies:
-                        export_taxanomies[t_domain] = []
-                    export_taxanomies[t_domain].append(t_entry)
-
-            def gi(q, unicode_wrap=True, empty=False):
-                namespace = ''
-                tag = q
-                if q.find(':') > 0:
-                    namespace, tag = q.split(':', 1)
-                try:
-                    result = i.find('.//' + ns[namespace] + tag).text
-                    if result is None:
-                        return '' if empty else None
-                except AttributeError:
-                    return '' if empty else None
-                if unicode_wrap:
-                    result = str(result)
-                return result
-
-            body = gi('content:encoded')
-            for key in body_replace:
-                body = re.sub(key, body_replace[key], body)
-
-            # Parse HTML content
-            soup_body = BeautifulSoup(body, 'html.parser')
-
-            # Extract image sources from body only
-            img_srcs = []
-            for img in soup_body.find_all('img'):
-                if 'src' in img.attrs:
-                    img_src = img['src']
-                    if is_valid_image(img_src):
-                        img_srcs.append(img_src)
-
-            # Remove duplicates
-            img_srcs = list(set(img_srcs))
-
-            # Extract comments
-            comments = []
-            if include_comments:
-                comment_elements = i.findall('.//wp:comment', namespaces={'wp': 'http://wordpress.org/export/1.2/'})
-                log(f"Number of comment elements found: {len(comment_elements)}")
-                for comment in comment_elements:
-                    comment_data = {
-                        'author': comment.find('wp:comment_author', namespaces={'wp': 'http://wordpress.org/export/1.2/'}).text.strip(),
-                        'date': comment.find('wp:comment_date', namespaces={'wp': 'http://wordpress.org/export/1.2/'}).text.strip(),
-                        'content': comment.find('wp:comment_content', namespaces={'wp': 'http://wordpress.org/export/1.2/'}).text.strip()
-                    }
-                    comments.append(comment_data)
-                log(f"Number of comments extracted: {len(comments)}")
-
-            export_item = {
-                'title': gi('title'),
-                'link': gi('link'),
-                'author': gi('dc:creator'),
-                'date': gi('wp:post_date_gmt'),
-                'slug': gi('wp:post_name'),
-                'status': gi('wp:status'),
-                'type': gi('wp:post_type'),
-                'wp_id': gi('wp:post_id'),
-                'parent': gi('wp:post_parent'),
-                'taxanomies': export_taxanomies,
-                'tags': tags,  # Add tags to the export item
-                'body': body,
-                'img_srcs': img_srcs,
-                'comments': gi('wp:comment_status') == u'open',
-                'comments': comments # if include_comments else []  # Only include comments if include_comments is True
-            }
-
-            export_items.append(export_item)
-
-        return export_items
+    def parse_item(i):
+        # One pass over the children of the item: the first element of each
+        # kind, and all categories and comments
+        fields = {}
+        taxanomies = []
+        comments = []
+        comment_tag = ns.get('wp', '') + 'comment'
+        for child in i:
+            if child.tag == 'category':
+                taxanomies.append(child)
+            elif child.tag == comment_tag:
+                if with_comments:
+                    comment = parse_comment(child)
+                    if not approved_comments_only or comment['approved'] == '1':
+                        comments.append(comment)
+            else:
+                fields.setdefault(child.tag, child.text)
+
+        export_taxanomies = {}
+        tags = ['pre-2010']  # New list to store tags
+        for tax in taxanomies:
+            if 'domain' not in tax.attrib:
+                continue
+            t_domain = str(tax.attrib['domain'])
+            t_entry = str(tax.attrib.get('nicename', tax.text.strip()))
+            if t_domain == 'category':  # If it's a category, add it to tags
+                tags.append(t_entry)
+            elif (not (t_domain in taxonomy_filter) and
+                  not (t_domain in taxonomy_entry_filter and
+                       taxonomy_entry_filter[t_domain] == t_entry)):
+                if t_domain not in export_taxanomies:
+                    export_taxanomies[t_domain] = []
+                export_taxanomies[t_domain].append(t_entry)
+
+        def gi(q):
+            namespace, _, tag = q.rpartition(':')
+            result = fields.get(ns[namespace] + tag)
+            return None if result is None else str(result)
+
+        body = gi('content:encoded')
+        if comments:
+            log(f"Number of comments extracted: {len(comments)}")
+
+        status = gi('wp:status')
+        post_type = gi('wp:post_type')
+        return Item(
+            title=gi('title'),
+            link=gi('link'),
+            author=gi('dc:creator'),
+            date=gi('wp:post_date_gmt'),
+            slug=gi('wp:post_name'),
+            # The same few values over and over, share one string for each
+            status=status if status is None else sys.intern(status),
+            type=post_type if post_type is None else sys.intern(post_type),
+            wp_id=gi('wp:post_id'),
+            guid=gi('guid'),
+            parent=gi('wp:post_parent'),
+            taxanomies=export_taxanomies,
+            tags=tags,
+            body=body,
+            comments=comments,
+            selected=True,
+        )
+
+    def parse_items(c, i):
+        try:
+            start = time.perf_counter()
+            while i is not None:
+                if i.tag == 'item':
+                    export_item = parse_item(i)
+                    if select is not None and not select(export_item):
+                        # Only named, not converted, so its body and
+                        # comments are not passed on
+                        export_item.selected = False
+                        export_item.body = None
+                        export_item.comments = []
+                    # Drop the finished item, so only one is kept in memory
+                    c.remove(i)
+                    if stage is not None:
+                        stats.add(stage, time.perf_counter() - start)
+                    yield export_item
+                    start = time.perf_counter()
+                else:
+                    c.remove(i)
+                c, i = next_channel_child()
+        finally:
+            source.close()
 
+    try:
+        header, c, first_item = parse_header()
+    except BaseException:
+        source.close()
+        raise
     return {
-        'header': parse_header(),
-        'items': parse_items(),
+        'header': header,
+        'items': parse_items(c, first_item),
+    }
+
+class ItemIndex:
+    """The items of one blog by wp_id, without their bodies.
+
+    It is built in a first pass over the blog's exports, so the page
+    hierarchy can be resolved while items are streamed, whatever their
+    order and whichever export file the parent is in. Ancestor chains are
+    memoized; parents that are missing from the exports and parent cycles
+    are reported once and cut off.
+
+    With a blog_link, the absolute URLs of the images in the bodies are
+    collected too, so links to them can be resolved whatever the order of
+    the items.
+
+    Exports of the same blog may reuse a wp_id for a different item. The
+    items of a later export that do are kept apart under a wp_id in the
+    namespace of their export, see update().
+    """
+
+    FIELDS = ('wp_id', 'parent', 'type', 'status', 'slug', 'title', 'date',
+              'link', 'guid')
+
+    def __init__(self, items=(), blog_link=None):
+        self.items = {}
+        self.digests = {}  # wp_id -> hash of the item, to tell items apart
+        self.ancestor_ids = {}
+        self.images = set()
+        for i in items:
+            self.add(i, blog_link)
+
+    def add(self, i, blog_link=None):
+        self.items[i['wp_id']] = Item(**{field: i[field] for field in self.FIELDS})
+        self.digests[i['wp_id']] = hashlib.sha256(json.dumps(
+            i.fields(), sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        if blog_link is not None and i['body']:
+            for tag, attr, *quoted in PLAN_URL_RE.findall(i['body']):
+                src = unescape(''.join(quoted))
+                if (tag.lower(), attr.lower()) == ('img', 'src') and src and is_valid_image(src):
+                    self.images.add(urljoin(blog_link, src))
+
+    def update(self, other, namespace=''):
+        """Add the items of another export of the blog.
+
+        An item whose wp_id is already taken by a different item gets
+        the wp_id <namespace>-<wp_id>, and so do the parent fields that
+        refer to it. Returns the renamed wp_ids, old -> new.
+        """
+        renamed = {wp_id: f'{namespace}-{wp_id}' for wp_id in other.items
+                   if wp_id in self.items and self.digests[wp_id] != other.digests[wp_id]}
+        for wp_id, item in other.items.items():
+            item.wp_id = renamed.get(wp_id, wp_id)
+            item.parent = renamed.get(item.parent, item.parent)
+            self.items.setdefault(item.wp_id, item)
+            self.digests.setdefault(item.wp_id, other.digests[wp_id])
+        self.images.update(other.images)
+        return renamed
+
+    def get(self, wp_id):
+        return self.items.get(wp_id)
+
+    def __contains__(self, wp_id):
+        return wp_id in self.items
+
+    def __iter__(self):
+        return iter(self.items.values())
+
+    def __len__(self):
+        return len(self.items)
+
+    def ancestors(self, wp_id):
+        """The wp_ids of the ancestors of an item, outermost first."""
+        if wp_id in self.ancestor_ids:
+            return self.ancestor_ids[wp_id]
+        chain = [wp_id]
+        base = []
+        while True:
+            item = self.items.get(chain[-1])
+            parent_id = item['parent'] if item is not None else None
+            if parent_id in (None, '', '0'):
+                break
+            if parent_id in self.ancestor_ids:
+                base = self.ancestor_ids[parent_id] + [parent_id]
+                break
+            if parent_id in chain:
+                print(f'\nWarning: parent cycle at item {chain[-1]} '
+                      f'(parent {parent_id}), it is placed at the top level')
+                break
+            if parent_id not in self.items:
+                print(f'\nWarning: parent {parent_id} of item {chain[-1]} '
+                      f'is not in the export, it is placed at the top level')
+                break
+            chain.append(parent_id)
+        for wp_id in reversed(chain):
+            self.ancestor_ids[wp_id] = base
+            base = base + [wp_id]
+        return self.ancestor_ids[chain[0]]
+
+
+def get_config_hash():
+    """Hash of everything besides the item itself that affects its output."""
+    relevant = {key: config.get(key) for key in (
+        'target_format', 'download_images', 'include_comments', 'taxonomies',
+        'tags_label', 'item_type_filter', 'item_field_filter', 'date_format',
+        'body_replace', 'html_parser', 'front_matter_format', 'comments_output',
+        'approved_comments_only', 'rewrite_links')}
+    relevant['image_settings'] = {key: image_config.get(key) for key in (
+        'excluded_url_parts', 'included_domains', 'default_image_validity',
+        'not_found_icon', 'optimize', 'download_linked_images')}
+    digest = hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode('utf-8'))
+    # A new version of this script may convert differently
+    with open(__file__, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """Records what was written for every item, so unchanged items can be
+    skipped on the next run.
+
+    Items are keyed by blog directory and wp_id. Each entry holds a hash of
+    the item's source fields and of the configuration, and the file that
+    was written for it. The names given to images are kept as well, so an
+    image keeps its name when the items before it are skipped, and the
+    options optimized images were made with.
+
+    The targets of an item's internal links are kept too: an item whose
+    links now lead elsewhere, or somewhere after all, is converted again
+    even though the item itself did not change.
+
+    Every entry also notes the run that wrote it, and the manifest whether
+    that run finished. With `resume`, the items written by an interrupted
+    run count as current, also when it was forced. With `retry_failed`,
+    items that were written with images missing are converted again.
+    """
+
+    SAVE_EVERY = 500
+
+    def __init__(self, path, force=False, resume=False, retry_failed=False):
+        self.path = path
+        self.force = force
+        self.retry_failed = retry_failed
+        self.config_hash = get_config_hash()
+        self.seen = set()
+        self.unsaved = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = {}
+        self.items = saved.get('items', {})
+        # Local image names by directory, see AttachmentAllocator
+        self.attachments = saved.get('attachments', {})
+        self.attachment_tags = saved.get('attachment_tags', {})
+        self.attachment_paths = saved.get('attachment_paths', {})
+        last_run = saved.get('run', {'finished': True})
+        self.resumed = None
+        if not last_run['finished']:
+            if resume:
+                self.resumed = last_run['id']
+                print('Resuming the interrupted run')
+            else:
+                print('The last run did not finish, use --resume to continue it')
+        self.run = {'id': self.resumed or uuid.uuid4().hex, 'finished': False}
+
+    def item_hash(self, i, fn):
+        data = json.dumps([self.config_hash, fn, i.fields()], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def is_current(self, key, digest, fn, link_target=None):
+        self.seen.add(key)
+        entry = self.items.get(key)
+        if entry is None or entry['hash'] != digest or entry['file'] != fn:
+            return False
+        if link_target is not None and any(
+                link_target(url) != path for url, path in entry.get('links', {}).items()):
+            return False
+        if self.retry_failed and entry.get('missing'):
+            return False
+        if self.force and (self.resumed is None or entry.get('run') != self.resumed):
+            return False
+        return os.path.exists(fn)
+
+    def record(self, key, digest, fn, data_file=None, missing=(), links=None):
+        entry = self.items.get(key)
+        if entry is not None and entry['file'] != fn:
+            remove_output(entry['file'])
+        if entry is not None and entry.get('data') not in (None, data_file):
+            remove_output(entry['data'])
+        self.items[key] = {'hash': digest, 'file': fn, 'run': self.run['id']}
+        if data_file is not None:
+            self.items[key]['data'] = data_file
+        if missing:
+            # Images that could not be downloaded, see --retry-failed
+            self.items[key]['missing'] = list(missing)
+        if links:
+            # URL -> path of the internal links, None for unresolved ones
+            self.items[key]['links'] = links
+        self.unsaved += 1
+        if self.unsaved >= self.SAVE_EVERY:
+            self.save()
+
+    def prune(self):
+        """Remove the output of items that were not part of this run."""
+        for key in sorted(set(self.items) - self.seen):
+            entry = self.items.pop(key)
+            log('  removed/' + key + ': ' + entry['file'])
+            remove_output(entry['file'])
+            if entry.get('data'):
+                remove_output(entry['data'])
+
+    def finish(self):
+        self.run['finished'] = True
+        self.save()
+
+    def save(self):
+        save_json(self.path, {'items': self.items, 'attachments': self.attachments,
+                              'attachment_tags': self.attachment_tags,
+                              'attachment_paths': self.attachment_paths, 'run': self.run})
+        self.unsaved = 0
+
+
+def remove_output(fn):
+    if os.path.exists(fn):
+        os.remove(fn)
+    if os.path.splitext(os.path.basename(fn))[0] == 'index':
+        # Page directories are only removed when nothing else is left in them
+        try:
+            os.rmdir(os.path.dirname(fn))
+        except OSError:
+            pass
+
+
+def write_output(path, text):
+    """Write a complete output file, unless it already has this content.
+
+    The file is written in one go to a temporary file that replaces the
+    old one, so it is never left half written, and a file whose content
+    did not change keeps its modification time. Returns whether the file
+    was written.
+    """
+    data = text.encode('utf-8')
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except FileNotFoundError:
+        pass
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+def render_front_matter(i):
+    item_url = urlparse(i['link'])
+    yaml_header = {
+        'title': i['title'],
+        'url': item_url.path,
+        # 'author': i['author'],
     }
 
-def write_hugo(data, target_format):
+    # Handle the date
+    date_str = i.get('date')
+    if date_str:
+        try:
+            # Parse the date string and set the timezone to CET
+            parsed_date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+            parsed_date = parsed_date.replace(tzinfo=CET())
+            yaml_header['date'] = parsed_date
+        except ValueError:
+            log(f"Warning: Invalid date format for item {i['wp_id']}: {date_str}. Date will be left empty.")
+    else:
+        log(f"Info: No date found for item {i['wp_id']}. Date will be left empty.")
+
+    # if i['status'] == u'publish':
+    #     yaml_header['draft'] = False
+
+    yaml_header['type'] = i['type']
+    if comments_output == 'data' and include_comments and i['comments']:
+        # Templates find the comments at site.Data.comments by wp_id
+        yaml_header['wp_id'] = i['wp_id']
+
+    # Add tags to the YAML header
+    if i['tags']:
+        yaml_header[tags_label] = list(i['tags'])
+
+    tax_out = {}
+    for taxonomy in i['taxanomies']:
+        if taxonomy != 'category':  # Skip 'category' as we're using it for tags
+            for tvalue in i['taxanomies'][taxonomy]:
+                t_name = taxonomy_name_mapping.get(taxonomy, taxonomy)
+                # A taxonomy can map to the tags_label, e.g. post_tag to
+                # 'tags'; its terms are added to that list, as the front
+                # matter may only have the key once
+                t_values = yaml_header.get(t_name)
+                if not isinstance(t_values, list):
+                    if t_name not in tax_out:
+                        tax_out[t_name] = []
+                    t_values = tax_out[t_name]
+                if tvalue in t_values:
+                    continue
+                t_values.append(tvalue)
+
+    return FRONT_MATTER_WRITERS[front_matter_format](yaml_header, tax_out)
+
+
+@functools.lru_cache(maxsize=None)
+def yaml_dumper():
+    """libyaml's dumper if PyYAML was built with it, else PyYAML's own."""
+    try:
+        from yaml import CSafeDumper
+        return CSafeDumper
+    except ImportError:
+        from yaml import SafeDumper
+        return SafeDumper
+
+def yaml_emittable(value):
+    if isinstance(value, list):
+        return all(isinstance(v, (str, datetime)) or v is None for v in value)
+    return isinstance(value, (str, datetime)) or value is None
+
+def toyaml(data):
+    # The few value types of the front matter are written here, so the
+    # output is the same on every machine and PyYAML's emitters (even
+    # libyaml's) are not paid for. Anything else goes to PyYAML.
+    if not all(isinstance(key, str) and yaml_emittable(value) for key, value in data.items()):
+        import yaml
+        return yaml.dump(data, Dumper=yaml_dumper(), allow_unicode=True,
+                         default_flow_style=False)
+    lines = []
+    for key in sorted(data):
+        value = data[key]
+        if isinstance(value, list):
+            lines.append(yaml_scalar(key) + (':' if value else ': []'))
+            lines.extend('- ' + yaml_scalar(v) for v in value)
+        else:
+            lines.append(yaml_scalar(key) + ': ' + yaml_scalar(value))
+    return '\n'.join(lines) + '\n'
+
+# Strings that can be written without quotes and still load as strings
+YAML_PLAIN_RE = re.compile(r'[A-Za-z_/][A-Za-z0-9 _./-]*(?<! )\Z')
+YAML_RESERVED_RE = re.compile(r'(y|yes|n|no|true|false|on|off|null)\Z', re.I)
+# Characters YAML does not allow, or folds, in a double-quoted string
+YAML_UNPRINTABLE_RE = re.compile('[\x7f-\x9f\ufeff\u2028\u2029\ufffe\uffff]')
+
+def yaml_scalar(value):
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if value is None:
+        return 'null'
+    value = str(value)
+    if YAML_PLAIN_RE.match(value) and not YAML_RESERVED_RE.match(value):
+        return value
+    # A JSON string is a valid double-quoted YAML scalar
+    return YAML_UNPRINTABLE_RE.sub(lambda m: '\\u%04x' % ord(m.group()),
+                                   json.dumps(value, ensure_ascii=False))
+
+def yaml_front_matter(header, taxonomies):
+    out = ['---\n']
+    if len(header) > 0:
+        out.append(toyaml(header))
+    if len(taxonomies) > 0:
+        out.append(toyaml(taxonomies))
+    out.append('---\n\n')
+    return ''.join(out)
+
+TOML_BARE_KEY_RE = re.compile(r'[A-Za-z0-9_-]+\Z')
+TOML_ESCAPES = {c: '\\u%04x' % c for c in [*range(0x20), 0x7f]}
+TOML_ESCAPES.update({ord('"'): '\\"', ord('\\'): '\\\\', ord('\b'): '\\b',
+                     ord('\t'): '\\t', ord('\n'): '\\n', ord('\f'): '\\f',
+                     ord('\r'): '\\r'})
+
+def toml_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        return '[' + ', '.join(toml_value(v) for v in value) + ']'
+    return '"' + str(value).translate(TOML_ESCAPES) + '"'
+
+def toml_front_matter(header, taxonomies):
+    out = ['+++\n']
+    for data in (header, taxonomies):
+        for key in sorted(data):
+            if data[key] is None:
+                continue  # TOML has no null
+            toml_key = key if TOML_BARE_KEY_RE.match(key) else toml_value(key)
+            out.append(f'{toml_key} = {toml_value(data[key])}\n')
+    out.append('+++\n\n')
+    return ''.join(out)
+
+def json_front_matter(header, taxonomies):
+    data = {key: header[key] for key in sorted(header)}
+    data.update((key, taxonomies[key]) for key in sorted(taxonomies))
+    return json.dumps(data, indent=2, ensure_ascii=False,
+                      default=lambda value: value.isoformat()) + '\n\n'
+
+FRONT_MATTER_WRITERS = {
+    'yaml': yaml_front_matter,
+    'toml': toml_front_matter,
+    'json': json_front_matter,
+}
+
+
+# Bump when a change to parse_html or render_item changes converted bodies
+CONVERSION_VERSION = 2
+
+class ConversionCache:
+    """Size-bounded cache of converted bodies, shared by all runs.
+
+    Entries are kept in an SQLite database, keyed by a hash of the body
+    after body_replace and of everything else its conversion depends on.
+    They hold the converted text and the image sources and internal links
+    found in it. Every
+    process opens its own connection; the least recently used entries are
+    evicted at the end of a run.
+    """
+
+    def __init__(self, path, max_size):
+        self.max_size = max_size
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS conversions (key TEXT PRIMARY KEY, '
+                            'text TEXT, images TEXT, size INTEGER, used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS conversions_used ON conversions (used)')
+
+    def get(self, key):
+        row = self.db.execute('SELECT text, images FROM conversions WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None:
+            return None
+        with self.db:
+            self.db.execute('UPDATE conversions SET used = ? WHERE key = ?', (time.time(), key))
+        images, links = json.loads(row[1])
+        return row[0], images, links
+
+    def put(self, key, text, images, links):
+        images = json.dumps([images, links])
+        size = len(key) + len(text.encode('utf-8', 'surrogatepass')) + len(images)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?)',
+                            (key, text, images, size, time.time()))
+
+    def evict(self):
+        """Remove the least recently used entries beyond max_size."""
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM conversions').fetchone()[0]
+        if total <= self.max_size:
+            return
+        with self.db:
+            for key, size in self.db.execute('SELECT key, size FROM conversions '
+                                             'ORDER BY used').fetchall():
+                if total <= self.max_size:
+                    break
+                self.db.execute('DELETE FROM conversions WHERE key = ?', (key,))
+                total -= size
+        self.db.execute('PRAGMA incremental_vacuum')
+
+    def close(self):
+        self.db.close()
+
+conversion_cache = None
+
+def get_conversion_cache():
+    """The conversion cache of this process, or None if it is disabled."""
+    global conversion_cache
+    if not CONVERSION_CACHE_SIZE or not CONVERSION_CACHE_PATH:
+        return None
+    # A connection must not be used across a fork
+    if conversion_cache is None or conversion_cache.pid != os.getpid():
+        conversion_cache = ConversionCache(CONVERSION_CACHE_PATH, CONVERSION_CACHE_SIZE)
+    return conversion_cache
+
+def close_conversion_cache():
+    """Evict the least recently used entries and close the cache."""
+    global conversion_cache
+    cache = get_conversion_cache()
+    if cache is not None:
+        cache.evict()
+        cache.close()
+    conversion_cache = None
+
+conversion_options = None
+
+def conversion_key(body, host):
+    global conversion_options
+    if conversion_options is None:
+        from importlib.metadata import PackageNotFoundError, version
+        versions = {}
+        for package in ('markdownify', 'beautifulsoup4', 'lxml', 'html5lib'):
+            try:
+                versions[package] = version(package)
+            except PackageNotFoundError:
+                versions[package] = None
+        conversion_options = json.dumps([
+            CONVERSION_VERSION, target_format, html_parser, MARKDOWN_OPTIONS, versions,
+            download_images, EXCLUDED_URL_PARTS, INCLUDED_DOMAINS, DEFAULT_IMAGE_VALIDITY,
+            IMAGE_SRCSET, rewrite_links, DOWNLOAD_LINKED_IMAGES,
+        ], sort_keys=True)
+    digest = hashlib.sha256(conversion_options.encode('utf-8'))
+    # Which links are internal depends on the host of the blog
+    digest.update(host.encode('utf-8') + b'\0')
+    digest.update(body.encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+def render_item(i):
+    """Render one item to the text of its output file.
+
+    This is the CPU heavy part of the conversion and only depends on the
+    item and the configuration, so it can run in a worker process. Image
+    sources that will be replaced by a local copy, and internal links,
+    are left as numbered placeholders; they are returned in document
+    order for write_hugo, which does the attachment naming, downloads and
+    link lookups, together with the time spent in each stage.
+    """
+    timings = {}
+    start = time.perf_counter()
+    out = [render_front_matter(i)]
+    start = lap(timings, 'front_matter', start)
+    # An empty <content:encoded> has no body at all
+    body = body_replacer(i['body'] or '')
+    start = lap(timings, 'body_replace', start)
+
+    image_srcs = []
+    links = []
+    host = link_host(i['link'])
+    placeholder = 'exitwp-image-' + uuid.uuid4().hex + '-'
+    if download_images or rewrite_links or target_format != 'html':
+        cache = get_conversion_cache()
+        cached = None
+        if cache is not None:
+            key = conversion_key(body, host)
+            # The placeholder is part of the cached text
+            placeholder = 'exitwp-image-' + key[:32] + '-'
+            cached = cache.get(key)
+            start = lap(timings, 'cache_hit' if cached else 'cache_miss', start)
+        if cached is not None:
+            markdown_content, image_srcs, links = cached
+            out.append(markdown_content)
+        else:
+            # The body is parsed once; image discovery, src and href
+            # rewriting and the conversion all work on the same tree
+            soup = parse_html(body)
+            names = (['img'] if download_images else []) + (['a'] if rewrite_links else [])
+            for tag in soup.find_all(names) if names else ():
+                if tag.name == 'img':
+                    original_src = tag.get('src', '')
+                    if not original_src or not is_valid_image(original_src):
+                        continue
+                    tag['src'] = placeholder + str(len(image_srcs)) + '-'
+                    if IMAGE_SRCSET:
+                        tag['srcset'] = placeholder + 's' + str(len(image_srcs)) + '-'
+                    tag['title'] = original_src
+                    image_srcs.append(original_src)
+                    continue
+                href = tag.get('href', '')
+                kind = internal_link(href, host)
+                if kind == 'upload' and download_images and DOWNLOAD_LINKED_IMAGES:
+                    href = urljoin(i['link'] or '', href)
+                    if is_valid_image(href):
+                        # A link to an uploaded image, usually the full size
+                        # of the image in it, gets a local copy as well
+                        tag['href'] = placeholder + str(len(image_srcs)) + '-'
+                        image_srcs.append(href)
+                        continue
+                if kind is not None:
+                    tag['href'] = placeholder + 'l' + str(len(links)) + '-'
+                    links.append(href)
+            start = lap(timings, 'html_parse', start)
+            try:
+                markdown_content = html2fmt(soup, target_format)
+                out.append(markdown_content)
+            except Exception as e:
+                print(f'\nParse error on: {i["title"]}. Error: {str(e)}')
+                markdown_content = None
+            start = lap(timings, 'html_convert', start)
+            if cache is not None and markdown_content is not None:
+                cache.put(key, markdown_content, image_srcs, links)
+                start = lap(timings, 'cache_store', start)
+    else:
+        out.append(body)
+
+    # Add comments
+    if include_comments and comments_output == 'inline' and i['comments']:
+        out.append('\n---\n\n### Comments\n\n')
+        for comment in i['comments']:
+            out.append(f"> Author: {comment['author']}<br>\n")
+            out.append(f"> Date: {comment['date']}\n\n")
+            content = comment['content'].replace('\n', '\n\n')  # Ensure proper line breaks in Markdown
+            out.append(f"{content}\n\n")
+    lap(timings, 'comments', start)
+
+    return ''.join(out), placeholder, image_srcs, links, timings
+
+def comment_threads(comments):
+    """Nest the comments of an item under the comments they reply to.
+
+    Replies are kept in export order. A comment whose parent is not among
+    the comments before it starts a thread of its own.
+    """
+    threads = []
+    nodes = {}
+    for comment in comments:
+        node = {
+            'id': comment['id'],
+            'author': comment['author'],
+            'date': comment['date'],
+            'content': comment['content'],
+            'approved': comment['approved'] == '1',
+            'replies': [],
+        }
+        parent = nodes.get(comment['parent'])
+        if parent is not None:
+            parent['replies'].append(node)
+        else:
+            threads.append(node)
+        nodes[comment['id']] = node
+    return threads
+
+def render_comment_data(i):
+    return json.dumps({
+        'wp_id': i['wp_id'],
+        'count': len(i['comments']),
+        'threads': comment_threads(i['comments']),
+    }, indent=1, ensure_ascii=False) + '\n'
+
+# Images in wp-content/uploads, which links are downloaded for
+UPLOADED_IMAGE_RE = re.compile(r'/wp-content/uploads/.+\.(?:jpe?g|png|gif|webp|avif|bmp|tiff?|svg)$',
+                               re.IGNORECASE)
+
+def link_host(url):
+    host = urlparse(url or '').netloc.lower()
+    return host[4:] if host.startswith('www.') else host
+
+def internal_link(href, host):
+    """'upload' for a link to an image uploaded to the blog, 'page' for
+    other links into the blog, None for anything else."""
+    if not href or href.startswith('#'):
+        return None
+    parts = urllib.parse.urlsplit(href)
+    if parts.scheme not in ('', 'http', 'https'):
+        return None
+    if parts.netloc and link_host(href) != host:
+        return None
+    return 'upload' if UPLOADED_IMAGE_RE.search(parts.path) else 'page'
+
+
+class LinkIndex:
+    """Where the posts and pages of a blog are in Hugo, by their old URLs.
+
+    Every item that is written can be found by its permalink, its guid
+    and, for ?p=123 and ?page_id=123 links, its wp_id; each leads to the
+    url in its front matter. Lookups are single dict lookups.
+    """
+
+    ID_PARAMETERS = ('p', 'page_id')
+
+    def __init__(self, index, blog_link):
+        self.host = link_host(blog_link)
+        self.root = self.path_key(urlparse(blog_link).path)
+        self.paths = {}
+        self.guids = {}
+        self.ids = {}
+        for item in index:
+            if item['type'] not in ('post', 'page') or any(
+                    item.get(field) == value for field, value in item_field_filter.items()):
+                continue
+            link = urlparse(item['link'] or '')
+            self.ids[item['wp_id']] = link.path
+            if not link.query:
+                self.paths.setdefault(self.path_key(link.path), link.path)
+            if item['guid']:
+                self.guids.setdefault(self.guid_key(item['guid']), link.path)
+
+    @staticmethod
+    def path_key(path):
+        return urllib.parse.unquote(path).rstrip('/')
+
+    @staticmethod
+    def guid_key(url):
+        parts = urllib.parse.urlsplit(url)
+        return link_host(url) + parts.path + '?' + parts.query
+
+    def resolve(self, url):
+        """The Hugo path of an absolute URL into the blog, None if the
+        URL is not one of its posts or pages."""
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.parse_qs(parts.query)
+        path = None
+        for name in self.ID_PARAMETERS:
+            if name in query:
+                path = self.ids.get(query[name][0])
+                break
+        else:
+            path = self.paths.get(self.path_key(parts.path))
+            if path is None and self.path_key(parts.path) == self.root:
+                path = '/'
+        if path is None:
+            path = self.guids.get(self.guid_key(url))
+        if path is not None and parts.fragment:
+            path += '#' + parts.fragment
+        return path
+
+
+def get_blog_path(data, path_infix='hugo'): #AW!! Changed jekyll path into hugo
+    name = data['header']['link']
+    name = re.sub('^https?', '', name)
+    name = re.sub('[^A-Za-z0-9_.-]', '', name)
+    return os.path.normpath(build_dir + '/' + path_infix + '/' + name)
+
+class ItemNamer:
+    """Gives posts and pages their uids, the names of their output files.
+
+    A uid is made of the slug (or title), with the date in front for posts,
+    and is unique within its namespace: the posts, or the parent page of a
+    page. Later items with a name that is already taken get `_2`, `_3`,
+    ...; these are listed in `collisions`.
+    """
+
+    def __init__(self):
+        self.item_uids = {}     # (blog_dir, namespace) -> {wp_id: uid}
+        self.taken_uids = {}    # (blog_dir, namespace) -> {uid: wp_id}
+        self.parent_paths = {}  # (blog_dir, wp_id) -> path of the parent pages
+        self.collisions = []
+
+    def uid(self, blog_dir, item, date_prefix=False, namespace=''):
+        key = (blog_dir, namespace)
+        uids = self.item_uids.setdefault(key, {})
+        if item['wp_id'] in uids:
+            return uids[item['wp_id']]
+
+        uid = []
+        if (date_prefix):
+            dt = datetime.strptime(item['date'], date_fmt)
+            uid.append(dt.strftime('%Y-%m-%d'))
+            uid.append('-')
+        s_title = item['slug']
+        if s_title is None or s_title == '':
+            s_title = item['title']
+        if s_title is None or s_title == '':
+            s_title = 'untitled'
+        s_title = s_title.replace(' ', '_')
+        s_title = re.sub('[^a-zA-Z0-9_-]', '', s_title)
+        uid.append(s_title)
+        fn = ''.join(uid)
+        taken = self.taken_uids.setdefault(key, {})
+        n = 1
+        while fn in taken:
+            n = n + 1
+            fn = ''.join(uid) + '_' + str(n)
+        if n > 1:
+            self.collisions.append({'blog': os.path.relpath(blog_dir, build_dir),
+                                    'namespace': namespace, 'uid': ''.join(uid),
+                                    'wp_id': item['wp_id'], 'taken_by': taken[''.join(uid)],
+                                    'renamed_to': fn})
+        uids[item['wp_id']] = fn
+        taken[fn] = item['wp_id']
+        return fn
+
+    def parent_path(self, data, item):
+        # Every page is named within the directory of its parent
+        blog_dir = data['blog_dir']
+        key = (blog_dir, item['wp_id'])
+        if key not in self.parent_paths:
+            path = ''
+            for parent_id in data['index'].ancestors(item['wp_id']):
+                parent = data['index'].get(parent_id)
+                path += self.uid(blog_dir, parent, namespace=path) + '/'
+            self.parent_paths[key] = path
+        return self.parent_paths[key]
+
+    def name(self, data, i, parentpath=''):
+        # An item that is not converted in this run still gets its uid,
+        # so the items after it are named exactly as in a complete run
+        if any(i[field] == value for field, value in item_field_filter.items()):
+            return
+        if i['type'] == 'post':
+            self.uid(data['blog_dir'], i, date_prefix=True, namespace='posts')
+        elif i['type'] == 'page':
+            self.uid(data['blog_dir'], i, namespace=parentpath)
+
+
+def write_hugo(exports, target_format, executor=None, window=1, downloader=None,
+               manifest=None, allocator=None, optimizer=None):
+    """Write the items of all exports, one export after the other.
+
+    Exports of the same blog write to the same directory, so post, page
+    and image names are kept unique per directory over all of them.
+    Returns a result dict for every item, in the order they were read.
+    """
 
     if verbose:
         log('writing..')
     else:
         sys.stdout.write('writing')
-    item_uids = {}
-    attachments = {}
-
-    def get_blog_path(data, path_infix='hugo'): #AW!! Changed jekyll path into hugo
-        name = data['header']['link']
-        name = re.sub('^https?', '', name)
-        name = re.sub('[^A-Za-z0-9_.-]', '', name)
-        return os.path.normpath(build_dir + '/' + path_infix + '/' + name)
-
-    blog_dir = get_blog_path(data)
+    results = []
+    namer = ItemNamer()
+    get_item_uid, get_parent_path, name_item = namer.uid, namer.parent_path, namer.name
 
-    def get_full_dir(dir):
+    def get_full_dir(blog_dir, dir):
         full_dir = os.path.normpath(blog_dir + '/' + dir)
         if (not os.path.exists(full_dir)):
             os.makedirs(full_dir)
         return full_dir
 
-    def open_file(file):
-        f = codecs.open(file, 'w', encoding='utf-8')
-        return f
-
-    def get_item_uid(item, date_prefix=False, namespace=''):
-        result = None
-        if namespace not in item_uids:
-            item_uids[namespace] = {}
-
-        if item['wp_id'] in item_uids[namespace]:
-            result = item_uids[namespace][item['wp_id']]
-        else:
-            uid = []
-            if (date_prefix):
-                dt = datetime.strptime(item['date'], date_fmt)
-                uid.append(dt.strftime('%Y-%m-%d'))
-                uid.append('-')
-            s_title = item['slug']
-            if s_title is None or s_title == '':
-                s_title = item['title']
-            if s_title is None or s_title == '':
-                s_title = 'untitled'
-            s_title = s_title.replace(' ', '_')
-            s_title = re.sub('[^a-zA-Z0-9_-]', '', s_title)
-            uid.append(s_title)
-            fn = ''.join(uid)
-            n = 1
-            while fn in item_uids[namespace]:
-                n = n + 1
-                fn = ''.join(uid) + '_' + str(n)
-                item_uids[namespace][i['wp_id']] = fn
-            result = fn
-        return result
-
-    def get_item_path(item, dir=''):
-        full_dir = get_full_dir(dir)
+    def get_item_path(blog_dir, item, dir=''):
+        full_dir = get_full_dir(blog_dir, dir)
         filename_parts = [full_dir, '/']
         filename_parts.append(item['uid'])
         if item['type'] == 'page':
@@ -328,119 +2352,92 @@ def write_hugo(data, target_format):
         filename_parts.append(extension)
         return ''.join(filename_parts)
 
-    def get_attachment_path_original(src, dir, dir_prefix='images'):
-        try:
-            files = attachments[dir]
-        except KeyError:
-            attachments[dir] = files = {}
-
-        try:
-            filename = files[src]
-        except KeyError:
-            file_root, file_ext = os.path.splitext(os.path.basename(urlparse(src)[2]))
-            file_infix = 1
+    def get_attachment_path(blog_dir, src, item_uid, item_type):
+        # Images of posts share one directory, pages have one per page
+        if src.startswith('data:'):
+            # Inline images are named by their content
+            import mimetypes
+            file_root = 'inline-' + hashlib.sha256(src.encode('utf-8')).hexdigest()[:12]
+            file_ext = mimetypes.guess_extension(src[5:].split(';')[0].split(',')[0]) or '.img'
+        else:
+            file_root, file_ext = os.path.splitext(os.path.basename(urlparse(src).path))
+        if item_type == 'post':
+            dir = 'posts'
+            if file_root + file_ext == '':
+                file_root, file_ext = '1', '.jpg'  # Default name if no filename is found
+        else:
+            dir = item_uid
             if file_root == '':
                 file_root = '1'
-            current_files = files.values()
-            maybe_filename = file_root + file_ext
-            while maybe_filename in current_files:
-                maybe_filename = file_root + '-' + str(file_infix) + file_ext
-                file_infix = file_infix + 1
-            files[src] = filename = maybe_filename
-
-        target_dir = os.path.normpath(blog_dir + '/' + dir_prefix + '/' + dir)
-        target_file = os.path.normpath(target_dir + '/' + filename)
-
-        if (not os.path.exists(target_dir)):
-            os.makedirs(target_dir)
-
-        return target_file, f'/{dir_prefix}/{dir}/{filename}'
-
-    image_counter = {}
-
-    def get_attachment_path(src, item_uid, item_type):
-        if item_type != 'post':
-            return get_attachment_path_original(src, item_uid)
-
-        parsed_url = urlparse(src)
-        file_name = os.path.basename(parsed_url.path)
-        if file_name == '':
-            file_name = '1.jpg'  # Default name if no filename is found
-
-        base_name, ext = os.path.splitext(file_name)
-
-        target_dir = os.path.normpath(blog_dir + '/images/posts')
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
-
-        # First, check if the file already exists in the target directory
-        if os.path.exists(os.path.join(target_dir, file_name)):
-            target_file = os.path.normpath(target_dir + '/' + file_name)
-            relative_path = '/images/posts/' + file_name
-            return target_file, relative_path
-
-        if src in image_sources:
-            # We've seen this exact URL before, use the same local filename
-            return image_sources[src]
-
-        counter = 0
-        while True:
-            if counter == 0:
-                new_file_name = file_name
-            else:
-                new_file_name = f"{base_name}-{counter}{ext}"
-
-            target_file = os.path.normpath(target_dir + '/' + new_file_name)
-            relative_path = '/images/posts/' + new_file_name
-
-            if not os.path.exists(target_file):
-                # This filename is not used, we can use it
-                image_sources[src] = (target_file, relative_path)
-                return target_file, relative_path
-
-            # If we're here, the filename exists.
-            # If it's for the same source URL, we can reuse it
-            if any(existing_src for existing_src, (existing_file, _) in image_sources.items()
-                   if existing_file == target_file and existing_src == src):
-                return target_file, relative_path
-
-            # If we're here, the filename exists but for a different source
-            # Try the next counter
-            counter += 1
-
-    def process_image(soup, img_tag, fn, item_uid, item_type):
-        if not download_images:
-            return  # Skip all image processing if download_images is False
-
-        original_src = img_tag.get('src', '')
-        if not original_src or not is_valid_image(original_src):
-            return
 
+        target_dir = os.path.normpath(blog_dir + '/images/' + dir)
+        source_ext = file_ext
+        optimized_ext = optimizer.target_ext(file_ext) if optimizer is not None else None
+        if optimized_ext is not None:
+            file_ext = optimized_ext
+        tag = optimizer.tag if optimized_ext is not None else None
+        filename = allocator.allocate(target_dir, src, file_root, file_ext, tag)
+        target_file = os.path.normpath(target_dir + '/' + filename)
+        relative_path = f'/images/{dir}/{filename}'
+        image = {'local_path': target_file, 'relative_path': relative_path,
+                 'on_disk': allocator.on_disk(target_dir, filename),
+                 'optimize': optimized_ext is not None, 'variants': []}
+        if optimized_ext is not None:
+            image['staging_path'] = optimizer.staging_path(src, source_ext)
+            if IMAGE_SRCSET:
+                name_root = os.path.splitext(filename)[0]
+                for width in IMAGE_OPTIMIZE['srcset_widths']:
+                    variant = allocator.allocate(target_dir, f'{src}#{width}w',
+                                                 f'{name_root}-{width}w', file_ext, tag)
+                    image['variants'].append((width, os.path.normpath(target_dir + '/' + variant),
+                                              f'/images/{dir}/{variant}'))
+        return image
+
+    def process_image(data, original_src, item_uid, item_type):
+        # Returns the new src, or a Future for a download still in flight
         full_img_url = urljoin(data['header']['link'], original_src)
-        local_path, relative_path = get_attachment_path(full_img_url, item_uid, item_type)
+        image = get_attachment_path(data['blog_dir'], full_img_url, item_uid, item_type)
+        local_path, relative_path = image['local_path'], image['relative_path']
+        variant_paths = [(width, path) for width, path, _ in image['variants']]
+        variants = [(width, src) for width, _, src in image['variants']]
 
-        if os.path.exists(local_path):
+        if image['on_disk']:
             log(f"Using existing local copy for {original_src}")
-            img_tag['src'] = relative_path
-        elif full_img_url != IMAGE_NOT_FOUND_ICON:
-            if download_image(full_img_url, local_path):
-                log(f"Downloaded image: {original_src}")
-                img_tag['src'] = relative_path
-            else:
-                log(f"Error: Image not found online: {original_src}")
-                img_tag['src'] = IMAGE_NOT_FOUND_ICON
-        else:
+            if variants:
+                return optimizer.on_disk(local_path, variant_paths), original_src, relative_path, variants
+            return relative_path
+        elif full_img_url == IMAGE_NOT_FOUND_ICON:
             log(f"Error: Invalid image source: {original_src}")
-            img_tag['src'] = IMAGE_NOT_FOUND_ICON
-
-        img_tag['title'] = original_src
-
-        # Preserve the original link destination
-        parent_a = img_tag.find_parent('a')
-        if parent_a and 'href' in parent_a.attrs:
-            parent_a['href'] = parent_a['href']  # Keep the original href
-
-    for i in data['items']:
+            return IMAGE_NOT_FOUND_ICON
+        elif image['optimize']:
+            download = downloader.submit(full_img_url, image['staging_path'])
+            future = optimizer.submit(full_img_url, download, image['staging_path'],
+                                      local_path, variant_paths)
+            return future, original_src, relative_path, variants
+        else:
+            return downloader.submit(full_img_url, local_path), original_src, relative_path, []
+
+    def downloaded_src(image):
+        # The new src and srcset of an image
+        if isinstance(image, str):
+            return image, image
+        future, original_src, relative_path, variants = image
+        result = future.result()
+        if result:
+            log(f"Downloaded image: {original_src}")
+            if result is True:
+                return relative_path, relative_path
+            width, widths = result
+            return relative_path, image_srcset(relative_path, width, variants, widths)
+        else:
+            log(f"Error: Image not found online: {original_src}")
+            return IMAGE_NOT_FOUND_ICON, IMAGE_NOT_FOUND_ICON
+
+    def write_item(data, i, parentpath=''):
+        result = {'export': data['file'], 'wp_id': i['wp_id'], 'type': i['type'],
+                  'title': i['title'], 'status': 'skipped', 'file': None,
+                  'images': 0, 'missing_images': 0, 'unresolved_links': []}
+        results.append(result)
         skip_item = None
 
         for field, value in item_field_filter.items():
@@ -450,135 +2447,638 @@ def write_hugo(data, target_format):
 
         if(skip_item):
             log('  skipped(field=' + skip_item + ')/' + i['wp_id'] + ': ' + i['title'])
-            continue
+            return
 
         if not verbose:
             sys.stdout.write('.')
             sys.stdout.flush()
-        out = None
-
-        item_url = urlparse(i['link'])
-        yaml_header = {
-            'title': i['title'],
-            'url': item_url.path,
-            # 'author': i['author'],
-        }
-
-        # Handle the date
-        date_str = i.get('date')
-        if date_str:
-            try:
-                # Parse the date string and set the timezone to CET
-                parsed_date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-                parsed_date = parsed_date.replace(tzinfo=CET())
-                yaml_header['date'] = parsed_date
-            except ValueError:
-                log(f"Warning: Invalid date format for item {i['wp_id']}: {date_str}. Date will be left empty.")
-        else:
-            log(f"Info: No date found for item {i['wp_id']}. Date will be left empty.")
-
-        # if i['status'] == u'publish':
-        #     yaml_header['draft'] = False
 
         log(f"Processing item: {i['title']}")
         log(f"Number of comments: {len(i['comments'])}")
 
+        blog_dir = data['blog_dir']
         if i['type'] == 'post':
-            i['uid'] = get_item_uid(i, date_prefix=True)
-            fn = get_item_path(i, dir='posts')
-            out = open_file(fn)
-            yaml_header['type'] = 'post'
+            i['uid'] = get_item_uid(blog_dir, i, date_prefix=True, namespace='posts')
+            fn = get_item_path(blog_dir, i, dir='posts')
         elif i['type'] == 'page':
-            i['uid'] = get_item_uid(i)
-            # Chase down parent path, if any
-            parentpath = ''
-            item = i
-            while item['parent'] != '0':
-                item = next((parent for parent in data['items']
-                             if parent['wp_id'] == item['parent']), None)
-                if item:
-                    parentpath = get_item_uid(item) + '/' + parentpath
-                else:
-                    break
-            fn = get_item_path(i, parentpath)
-            out = open_file(fn)
-            yaml_header['type'] = 'page'
+            i['uid'] = get_item_uid(blog_dir, i, namespace=parentpath)
+            fn = get_item_path(blog_dir, i, parentpath)
         elif i['type'] in item_type_filter:
             log('  skipped(type=' + i['type'] + ')/' + i['wp_id']+ ': ' + i['title'])
-            continue
+            return
         else:
             print('Unknown item type :: ' + i['type'])
-            continue
+            result['status'] = 'unknown_type'
+            return
 
-        if download_images:
-            soup = BeautifulSoup(i['body'], 'html.parser')
-            for img in soup.find_all('img'):
-                process_image(soup, img, fn, i['uid'], i['type'])
-            i['body'] = str(soup)
-
-        if out is not None:
-            def toyaml(data):
-                return yaml.safe_dump(data, allow_unicode=True,
-                                      default_flow_style=False)
-
-            # Add tags to the YAML header
-            if i['tags']:
-                yaml_header[tags_label] = i['tags']
-
-            tax_out = {}
-            for taxonomy in i['taxanomies']:
-                if taxonomy != 'category':  # Skip 'category' as we're using it for tags
-                    for tvalue in i['taxanomies'][taxonomy]:
-                        t_name = taxonomy_name_mapping.get(taxonomy, taxonomy)
-                        if t_name not in tax_out:
-                            tax_out[t_name] = []
-                        if tvalue in tax_out[t_name]:
-                            continue
-                        tax_out[t_name].append(tvalue)
-
-            out.write('---\n')
-            if len(yaml_header) > 0:
-                out.write(toyaml(yaml_header))
-            if len(tax_out) > 0:
-                out.write(toyaml(tax_out))
-
-            out.write('---\n\n')
-            try:
-                markdown_content = html2fmt(i['body'], target_format)
-                out.write(markdown_content)
-            except Exception as e:
-                print(f'\nParse error on: {i["title"]}. Error: {str(e)}')
+        result['file'] = fn
+        manifest_key = os.path.relpath(blog_dir, build_dir) + '/' + i['wp_id']
+        item_hash = manifest.item_hash(i, fn)
+        if manifest.is_current(manifest_key, item_hash, fn,
+                               functools.partial(link_target, data) if rewrite_links else None):
+            log('  unchanged/' + i['wp_id'] + ': ' + i['title'])
+            result['status'] = 'unchanged'
+            return
+        i['manifest'] = manifest_key, item_hash
+        i['result'] = result
+        if comments_output == 'data' and include_comments and i['comments']:
+            # A Hugo data file, data/comments/<wp_id>.json
+            i['comments_file'] = os.path.normpath(
+                blog_dir + '/data/comments/' + i['wp_id'] + '.json')
+
+        if executor is None:
+            rendered = render_item(i)
+            i.drop_body()
+            finish_item(data, i, fn, rendered)
+        else:
+            # The item is pickled later, in the background, so the worker
+            # gets a copy that still has the body
+            future = executor.submit(render_item, copy.copy(i))
+            i.drop_body()
+            pending.append((data, i, fn, future))
+            if len(pending) >= window:
+                finish_pending(1)
+
+    def link_target(data, url):
+        # The Hugo path of an absolute internal URL: the post or page, or
+        # the local copy of an uploaded image that was downloaded anyway
+        if not UPLOADED_IMAGE_RE.search(urlparse(url).path):
+            return data['links'].resolve(url)
+        location = allocator.find(url)
+        images_dir = os.path.join(data['blog_dir'], 'images') + os.sep
+        if location is None or not location.startswith(images_dir):
+            return None
+        return '/images/' + os.path.relpath(location, images_dir).replace(os.sep, '/')
+
+    def resolve_links(data, i, links):
+        # The new hrefs of the internal links of an item; links that lead
+        # nowhere are kept and reported
+        hrefs = []
+        targets = i['link_targets'] = {}
+        base = i['link'] or data['header']['link']
+        for href in links:
+            url = urljoin(base, href)
+            path = targets[url] = link_target(data, url)
+            if path is None:
+                log(f"Unresolved internal link in {i['title']}: {href}")
+                i['result']['unresolved_links'].append(href)
+                path = href
+            hrefs.append(path)
+        return hrefs
+
+    def waits_for_image(data, i, links):
+        # Whether the item links to an image that has no local copy yet,
+        # but gets one for an item after it
+        base = i['link'] or data['header']['link']
+        return any(url in data['index'].images and link_target(data, url) is None
+                   for url in (urljoin(base, href) for href in links))
+
+    def finish_item(data, i, fn, rendered):
+        text, placeholder, image_srcs, links, timings = rendered
+        for stage, seconds in timings.items():
+            stats.add(stage, seconds)
+        i['seconds'] = sum(timings.values())
+        images = [process_image(data, src, i['uid'], i['type']) for src in image_srcs]
+        if rewrite_links and waits_for_image(data, i, links):
+            linking.append((data, i, fn, text, placeholder, images, links))
+            return
+        with stats.timed('link_lookup'):
+            hrefs = resolve_links(data, i, links)
+        downloading.append((i, fn, text, placeholder, images, hrefs))
+        write_downloaded()
+
+    def write_file(i, fn, text, placeholder, images, hrefs):
+        missing_images, missing = 0, []
+        if images or hrefs:
+            with stats.timed('image_wait'):
+                srcs = [downloaded_src(image) for image in images]
+            missing_images = [src for src, srcset in srcs].count(IMAGE_NOT_FOUND_ICON)
+            # The images that failed to download, for --retry-failed
+            missing = [image[1] for image, (src, srcset) in zip(images, srcs)
+                       if src == IMAGE_NOT_FOUND_ICON and not isinstance(image, str)]
+            values = {'': [src for src, srcset in srcs], 's': [srcset for src, srcset in srcs],
+                      'l': hrefs}
+            if target_format == 'html':
+                from bs4.dammit import EntitySubstitution
+                values = {kind: [EntitySubstitution.substitute_xml(value).replace('"', '&quot;')
+                                 for value in kind_values]
+                          for kind, kind_values in values.items()}
+            # <placeholder><n>- is the src of image n, <placeholder>s<n>- its
+            # srcset and <placeholder>l<n>- the href of internal link n
+            text = re.sub(re.escape(placeholder) + r'([sl]?)(\d+)-',
+                          lambda m: values[m.group(1)][int(m.group(2))], text)
+
+        start = time.perf_counter()
+        written = write_output(fn, text)
+        seconds = time.perf_counter() - start
+        stats.add('disk_write' if written else 'disk_identical', seconds)
+        stats.add_item(i, i['seconds'] + seconds)
+        data_file = i.get('comments_file')
+        if data_file is not None:
+            with stats.timed('comment_data'):
+                os.makedirs(os.path.dirname(data_file), exist_ok=True)
+                write_output(data_file, render_comment_data(i))
+        manifest.record(*i['manifest'], fn, data_file, missing, i['link_targets'])
+        i['result'].update(status='written' if written else 'identical',
+                           images=len(images), missing_images=missing_images)
+        if written:
+            log('  written/' + i['wp_id'] + ': ' + i['title'])
+        else:
+            log('  identical/' + i['wp_id'] + ': ' + i['title'])
+
+    # Rendered items are finished in the order they were read, so naming
+    # happens exactly as in a serial run. The window runs on from one
+    # export into the next.
+    pending = deque()
+
+    def finish_pending(count=None):
+        while pending and count != 0:
+            data, i, fn, future = pending.popleft()
+            finish_item(data, i, fn, future.result())
+            if count is not None:
+                count -= 1
+
+    # Items that link to images of later items wait here until all items
+    # are named, so their links do not depend on the order of the items
+    linking = []
+
+    # Items wait here until their images are downloaded, while the
+    # downloads of the items after them keep running.
+    downloading = deque()
+
+    def write_downloaded(wait=False):
+        while downloading:
+            images = downloading[0][4]
+            done = all(isinstance(image, str) or image[0].done() for image in images)
+            if not (done or wait or len(downloading) > MAX_DOWNLOADING_ITEMS):
+                break
+            write_file(*downloading.popleft())
+
+    for data in exports:
+        data['blog_dir'] = get_blog_path(data)
+        for i in data['items']:
+            parentpath = get_parent_path(data, i) if i['type'] == 'page' else ''
+            if i['selected']:
+                write_item(data, i, parentpath)
+            else:
+                name_item(data, i, parentpath)
+
+    finish_pending()
+    for data, i, fn, text, placeholder, images, links in linking:
+        with stats.timed('link_lookup'):
+            hrefs = resolve_links(data, i, links)
+        downloading.append((i, fn, text, placeholder, images, hrefs))
+    write_downloaded(wait=True)
+    print('\n')
+    return results
+
+
+def index_export(file):
+    """Read the header and the item index of an export."""
+    start = time.perf_counter()
+    data = parse_wp_xml(file, stage=None, with_comments=False)
+    blog_link = data['header']['link'] if download_images and rewrite_links else None
+    index = ItemIndex(data['items'], blog_link)
+    return data['header'], index, time.perf_counter() - start
+
+
+def index_exports(files, executor=None):
+    """Read the headers and indexes of all exports, in parallel with an
+    executor.
+
+    Exports of the same blog share one index, so pages can have their
+    parent in another export file.
+    """
+    exports = []
+    indexes = {}  # blog_dir -> ItemIndex
+    results = map(index_export, files) if executor is None else executor.map(index_export, files)
+    for file, (header, index, seconds) in zip(files, results):
+        stats.add('xml_index', seconds, calls=len(index))
+        data = {'file': file, 'header': header}
+        blog_index = indexes.setdefault(get_blog_path(data), ItemIndex())
+        data['renamed'] = blog_index.update(index, os.path.basename(file).split('.')[0])
+        if data['renamed']:
+            print(f"\nWarning: {len(data['renamed'])} items in {file} have the wp_id of "
+                  f"another item of the blog, they are converted as <export>-<wp_id>")
+            for wp_id, new_id in data['renamed'].items():
+                log(f'  {wp_id} -> {new_id}')
+        data['index'] = blog_index
+        exports.append(data)
+    links = {}  # blog_dir -> LinkIndex
+    for data in exports if rewrite_links else ():
+        blog_dir = get_blog_path(data)
+        if blog_dir not in links:
+            links[blog_dir] = LinkIndex(data['index'], data['header']['link'])
+        data['links'] = links[blog_dir]
+    return exports
+
+
+def renamed_items(data, items):
+    """The items of an export, with the wp_ids index_exports gave the
+    items that reuse the wp_id of another item of the blog."""
+    renamed = data.get('renamed')
+    for i in items:
+        if renamed:
+            i['wp_id'] = renamed.get(i['wp_id'], i['wp_id'])
+            i['parent'] = renamed.get(i['parent'], i['parent'])
+        yield i
+
+
+def feed_items(file, queue, config, verbose_flag, select=None):
+    """Parse an export in a separate process and pass its items on."""
+    init_worker(config, verbose_flag)
+    try:
+        seconds = 0.0
+        count = 0
+        start = time.perf_counter()
+        for i in parse_wp_xml(file, stage=None, select=select)['items']:
+            seconds += time.perf_counter() - start
+            count += 1
+            queue.put(('item', i))
+            start = time.perf_counter()
+        queue.put(('done', count, seconds))
+    except Exception as e:
+        queue.put(('error', f'{file}: {e}', None))
 
-            # Add comments
-            if include_comments and i['comments']:
-                out.write('\n---\n\n### Comments\n\n')
-                for comment in i['comments']:
-                    out.write(f"> Author: {comment['author']}<br>\n")
-                    out.write(f"> Date: {comment['date']}\n\n")
-                    content = comment['content'].replace('\n', '\n\n')  # Ensure proper line breaks in Markdown
-                    out.write(f"{content}\n\n")
 
-            out.close()
-            log('  written/' + i['wp_id'] + ': ' + i['title'])
+def fed_items(queue, process):
+    while True:
+        message = queue.get()
+        if message[0] == 'item':
+            yield message[1]
+            continue
+        process.join()
+        if message[0] == 'error':
+            raise RuntimeError('reading export failed: ' + message[1])
+        stats.add('xml_parse', message[2], calls=message[1])
+        return
+
+
+def read_exports(exports, ahead=0, select=None):
+    """Attach the item stream to every export, as it is reached.
+
+    With ahead, the next `ahead` exports are parsed in separate processes
+    while the items of the current one are written; the items still come
+    out one export after the other. Items that select leaves out come
+    without body and comments.
+    """
+    feeders = {}
+
+    def start_feeder(n):
+        queue = PROCESS_CONTEXT.Queue(FEED_QUEUE_SIZE)
+        process = PROCESS_CONTEXT.Process(target=feed_items, daemon=True,
+                                          args=(exports[n]['file'], queue, config, verbose,
+                                                select))
+        process.start()
+        feeders[n] = queue, process
+
+    for n, data in enumerate(exports):
+        if ahead:
+            for m in range(n, min(n + ahead, len(exports))):
+                if m not in feeders:
+                    start_feeder(m)
+            items = fed_items(*feeders.pop(n))
+        else:
+            items = parse_wp_xml(data['file'], select=select)['items']
+        data['items'] = renamed_items(data, items)
+        yield data
+
+
+def report_unresolved_links(manifest):
+    """List the internal links that lead nowhere in
+    build_dir/unresolved-links.json, for all items in the build manifest,
+    so also the ones that were unchanged or in another shard."""
+    unresolved = {}
+    for entry in manifest.items.values():
+        urls = [url for url, path in entry.get('links', {}).items() if path is None]
+        if urls:
+            unresolved[entry['file']] = urls
+    path = os.path.join(build_dir, 'unresolved-links.json')
+    save_json(path, unresolved)
+    if unresolved:
+        count = sum(len(links) for links in unresolved.values())
+        print(f'{count} internal links in {len(unresolved)} items could not be '
+              f'resolved, they are listed in {path}')
+
+
+def init_worker(config, verbose_flag):
+    global verbose
+    configure(config)
+    verbose = verbose_flag
+
+
+def convert(export_path=None, config=None, force=False, jobs=1, verbose=None,
+            slowest=10, shard=None, since=None, until=None, ids=None, resume=False,
+            retry_failed=False):
+    """Convert WordPress exports to Hugo content.
+
+    export_path is an export file or a directory of them, by default the
+    wp_exports directory of the configuration. config is a dict with the
+    settings of config.yaml, or the path of such a file (default:
+    config.yaml in the current directory). jobs is the number of worker
+    processes (0: one per CPU); verbose overrides the verbose setting.
+
+    Only part of the items is converted with shard, a (k, N) tuple for
+    the k-th of N shards by wp_id, since and until, datetimes the post
+    date must be in, or ids, the wp_ids to convert. The other items are
+    still named, so every item gets the same file name in any selection;
+    in shards, image names get a hash of their URL to stay unique.
+
+    resume continues a run that was interrupted, skipping the items it
+    already wrote even when forced. retry_failed tries the image
+    downloads that failed in earlier runs again, and converts the items
+    that are missing images again.
+
+    Returns a dict for every item with its export, wp_id, type, title,
+    status ('written', 'identical', 'unchanged', 'skipped' or
+    'unknown_type'), output file, number of images and of images that
+    could not be downloaded, and the internal links that could not be
+    resolved. The profile of the run is left in
+    `stats`. Settings are module wide, so run one conversion at a time
+    per process.
+    """
+    global stats
+    if config is None or isinstance(config, str):
+        config = load_config(config or 'config.yaml')
+    check_config(config)
+    verbose_flag = config['verbose'] if verbose is None else verbose
+    init_worker(config, verbose_flag)
+    stats = Stats(slowest)
+
+    if include_comments:
+        log('Comments will be included in the export.')
+    else:
+        log('Comments will not be included in the export.')
+
+    select = ItemSelection(shard, since, until, ids) or None
+    if shard is not None and not 1 <= shard[0] <= shard[1]:
+        raise ValueError(f'No shard {shard[0]} of {shard[1]}')
+
+    # Output of items that are gone is only removed when all items of all
+    # exports of the configuration are converted
+    prune = select is None and (export_path is None or os.path.isdir(export_path))
+    export_path = wp_exports if export_path is None else export_path
+    if os.path.isdir(export_path):
+        export_files = find_exports(export_path)
+    else:
+        export_files = [export_path]
+
+    jobs = jobs or os.cpu_count() or 1
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs, mp_context=PROCESS_CONTEXT,
+                                       initializer=init_worker, initargs=(config, verbose_flag))
+    image_cache = None
+    if download_images and IMAGE_CACHE_DIR:
+        image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_REVALIDATE)
+    journal = None
+    if download_images:
+        journal = DownloadJournal(os.path.join(build_dir, 'download-journal.sqlite3'),
+                                  retry_failed=retry_failed)
+        if resume and journal.pending():
+            print(f'{journal.pending()} image downloads were interrupted, trying them again')
+    downloader = ImageDownloader(cache=image_cache, journal=journal)
+    optimizer = None
+    if download_images and IMAGE_OPTIMIZE:
+        optimizer = ImageOptimizer(IMAGE_OPTIMIZE, os.path.join(build_dir, 'image-staging'),
+                                   IMAGE_CACHE_DIR and os.path.join(IMAGE_CACHE_DIR, 'optimized'))
+    manifest = None
+    try:
+        os.makedirs(build_dir, exist_ok=True)
+        manifest = BuildManifest(os.path.join(build_dir, 'build-manifest.json'),
+                                 force=force, resume=resume, retry_failed=retry_failed)
+        allocator = AttachmentAllocator(manifest.attachments, hashed=shard is not None,
+                                        tags=manifest.attachment_tags,
+                                        paths=manifest.attachment_paths)
+
+        exports = index_exports(export_files, executor)
+        results = write_hugo(read_exports(exports, ahead=jobs if jobs > 1 else 0,
+                                          select=select),
+                             target_format, executor, window=4 * jobs,
+                             downloader=downloader, manifest=manifest,
+                             allocator=allocator, optimizer=optimizer)
+
+        if prune:
+            manifest.prune()
+        manifest.finish()
+        if rewrite_links:
+            report_unresolved_links(manifest)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        downloader.shutdown()
+        if manifest is not None and not manifest.run['finished']:
+            # Keep what was written so far for --resume
+            manifest.save()
+        if optimizer is not None:
+            optimizer.shutdown()
+        close_conversion_cache()
+    return results
+
+
+# Image sources and link targets, found without parsing the HTML for --plan
+# and the item index
+PLAN_URL_RE = re.compile(r'<(img|a)\b[^>]*?\s(src|href)\s*=\s*'
+                         r'(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))', re.IGNORECASE)
+PLAN_TAG_RE = re.compile(r'<[^>]*>')
+
+
+def plan(export_path=None, config=None, verbose=None, shard=None, since=None, until=None,
+         ids=None):
+    """Report what convert() would do, without converting anything.
+
+    The exports are parsed and indexed and every item is named as in a
+    real run, but the bodies are not converted, no images are downloaded
+    and nothing is written. The arguments are those of convert().
+
+    Returns a dict with the number of items that would be converted per
+    type, the items every item_type_filter and item_field_filter rule
+    (or the selection) leaves out, the images per host that would be
+    downloaded and the ones is_valid_image rejects, an estimate of the
+    size of the output and the items whose uid was already taken.
+    """
+    global stats
+    if config is None or isinstance(config, str):
+        config = load_config(config or 'config.yaml')
+    check_config(config)
+    init_worker(config, config['verbose'] if verbose is None else verbose)
+    stats = Stats()
+    start = time.perf_counter()
+
+    select = ItemSelection(shard, since, until, ids) or None
+    export_path = wp_exports if export_path is None else export_path
+    if os.path.isdir(export_path):
+        export_files = find_exports(export_path)
+    else:
+        export_files = [export_path]
+
+    report = {
+        'exports': export_files,
+        'items': 0,
+        'convert': {},
+        'skipped': {'not_selected': 0, 'item_field_filter': {}, 'item_type_filter': {},
+                    'unknown_type': {}},
+        'images': {},
+        'excluded_images': {},
+        'estimated_bytes': {'content': 0, 'comment_data': 0},
+    }
+    images = {}  # URL -> number of references
+    excluded = {}
+
+    def count(counts, key):
+        counts[key] = counts.get(key, 0) + 1
+
+    def find_images(i, data, body):
+        # The same sources render_item would download, found with a
+        # regular expression instead of an HTML parser. Returns the length
+        # of all sources and link targets, which Markdown keeps.
+        host = link_host(i['link'])
+        length = 0
+        for tag, attr, *quoted in PLAN_URL_RE.findall(body):
+            src = unescape(''.join(quoted))
+            if not src:
+                continue
+            length += len(src)
+            if not download_images:
+                continue
+            if (tag.lower(), attr.lower()) == ('img', 'src'):
+                full_url = urljoin(data['header']['link'], src)
+                valid = is_valid_image(src)
+            elif (tag.lower(), attr.lower()) == ('a', 'href') and DOWNLOAD_LINKED_IMAGES:
+                if '/wp-content/uploads/' not in src or internal_link(src, host) != 'upload':
+                    continue
+                full_url = urljoin(data['header']['link'], urljoin(i['link'] or '', src))
+                valid = is_valid_image(full_url)
+            else:
+                continue
+            if valid:
+                images[full_url] = images.get(full_url, 0) + 1
+            else:
+                count(excluded, urlparse(full_url).netloc)
+        return length
+
+    def estimate_size(i, data):
+        size = len(render_front_matter(i).encode('utf-8'))
+        body = body_replacer(i['body'] or '')
+        urls = find_images(i, data, body)
+        if target_format != 'html':
+            # Markdown is about as long as the text without the tags, and
+            # the addresses of the images and links
+            body = unescape(PLAN_TAG_RE.sub('', body))
+            size += urls
+        size += len(body.encode('utf-8'))
+        if include_comments and i['comments']:
+            if comments_output == 'data':
+                report['estimated_bytes']['comment_data'] += len(
+                    render_comment_data(i).encode('utf-8'))
+            else:
+                size += sum(len(comment['content'].encode('utf-8')) + 50
+                            for comment in i['comments'])
+        report['estimated_bytes']['content'] += size
+
+    namer = ItemNamer()
+    exports = index_exports(export_files)
+    for data in exports:
+        data['blog_dir'] = get_blog_path(data)
+        for i in renamed_items(data, parse_wp_xml(data['file'], select=select)['items']):
+            report['items'] += 1
+            parentpath = namer.parent_path(data, i) if i['type'] == 'page' else ''
+            if not i['selected']:
+                report['skipped']['not_selected'] += 1
+                namer.name(data, i, parentpath)
+                continue
+            rule = next((f'{field}={value}' for field, value in item_field_filter.items()
+                         if i[field] == value), None)
+            if rule is not None:
+                count(report['skipped']['item_field_filter'], rule)
+                continue
+            if i['type'] not in ('post', 'page'):
+                if i['type'] in item_type_filter:
+                    count(report['skipped']['item_type_filter'], i['type'])
+                else:
+                    count(report['skipped']['unknown_type'], i['type'])
+                continue
+            namer.name(data, i, parentpath)
+            count(report['convert'], i['type'])
+            estimate_size(i, data)
+
+    for url, references in images.items():
+        host = report['images'].setdefault(urlparse(url).netloc, {'images': 0, 'references': 0})
+        host['images'] += 1
+        host['references'] += references
+    report['excluded_images'] = excluded
+    report['uid_collisions'] = namer.collisions
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def print_plan(report):
+    print(f"\nplan for {len(report['exports'])} export(s), {report['items']} items "
+          f"({report['seconds']:.2f} s)\n")
+    for kind, number in sorted(report['convert'].items()):
+        print(f'  {kind + "s to convert":<40}{number:>8}')
+    skipped = report['skipped']
+    if skipped['not_selected']:
+        print(f"  {'not selected':<40}{skipped['not_selected']:>8}")
+    for label, key in (('item_field_filter', 'item_field_filter'),
+                       ('item_type_filter', 'item_type_filter'),
+                       ('unknown type', 'unknown_type')):
+        for rule, number in sorted(skipped[key].items()):
+            print(f'  {"skipped by " + label + " " + rule:<40}{number:>8}')
+
+    if report['images'] or report['excluded_images']:
+        print(f"\n  {'image host':<30}{'images':>10}{'uses':>10}{'excluded':>10}")
+        for host in sorted(set(report['images']) | set(report['excluded_images'])):
+            entry = report['images'].get(host, {'images': 0, 'references': 0})
+            print(f"  {host:<30}{entry['images']:>10}{entry['references']:>10}"
+                  f"{report['excluded_images'].get(host, 0):>10}")
+
+    size = report['estimated_bytes']
+    print(f"\n  estimated output size: {size['content'] / 1e6:.1f} MB content"
+          + (f", {size['comment_data'] / 1e6:.1f} MB comment data" if size['comment_data'] else '')
+          + ', without images')
+
+    collisions = report['uid_collisions']
+    print(f'\n  {len(collisions)} uid collision(s)')
+    for collision in collisions:
+        path = '/'.join(part.strip('/') for part in (collision['blog'], collision['namespace'])
+                        if part)
+        print(f"  {path}/{collision['uid']} is taken by {collision['taken_by']}, "
+              f"{collision['wp_id']} becomes {collision['renamed_to']}")
+
+
+def parse_date(value):
+    try:
+        return gmt_datetime(datetime.fromisoformat(value))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a date like 2019-01-01 "
+                                         f"or 2019-01-01T12:00:00+02:00")
 
-    print('\n')
 
-for arg in range(1, len(sys.argv)):
-    if sys.argv[arg] == '-v':
-        verbose = True
-    elif sys.argv[arg] == '-h':
-        print('''
-usage: {} [-h(elp)] [-v(erbose)]
+def parse_ids(value):
+    return [wp_id.strip() for wp_id in value.split(',') if wp_id.strip()]
 
-Options:
-  -h    Show this help message and exit
-  -v    Enable verbose output
 
+def parse_shard(value):
+    try:
+        k, n = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not of the form K/N")
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f'No shard {k} of {n}')
+    return k, n
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='''
 Configuration:
   All major settings are configured in the 'config.yaml' file.
   Key settings include:
 
-  - wp_exports: Directory containing WordPress export XML files
+  - wp_exports: Directory containing WordPress export XML files (.xml,
+    or compressed .xml.gz, .xml.bz2 or .xml.xz)
   - build_dir: Target directory for output
   - download_images: Whether to download and relocate images
   - image_settings: Configure image processing behavior
@@ -598,12 +3098,74 @@ Configuration:
 
   For more detailed configuration options, please refer to the comments
   in the config.yaml file.
-'''.format(sys.argv[0]))
-        sys.exit(0)
-print('starting..')
-wp_exports = glob(wp_exports + '/*.xml')
-for wpe in wp_exports:
-    data = parse_wp_xml(wpe)
-    write_hugo(data, target_format)
-
-print('done')
+''')
+    arg_parser.add_argument('-v', action='store_true',
+                            help='Enable verbose output')
+    arg_parser.add_argument('--force', action='store_true',
+                            help='Convert all items, also the ones that did not '
+                                 'change since the last run')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                            help='Convert items in N worker processes '
+                                 '(0: one per CPU, default: 1)')
+    arg_parser.add_argument('--profile', type=int, nargs='?', const=10, metavar='N',
+                            help='Print the time spent in each stage, image '
+                                 'download metrics and the N slowest items '
+                                 '(default: 10) at the end of the run')
+    arg_parser.add_argument('--stats-json', metavar='FILE',
+                            help='Write the profile of the run to FILE as JSON')
+    arg_parser.add_argument('--shard', type=parse_shard, metavar='K/N',
+                            help='Convert only the K-th of N shards of the items, '
+                                 'split by wp_id, e.g. 1/4 to 4/4 on four machines')
+    arg_parser.add_argument('--since', type=parse_date, metavar='DATE',
+                            help='Convert only items posted at or after DATE '
+                                 '(YYYY-MM-DD[ HH:MM:SS], GMT)')
+    arg_parser.add_argument('--until', type=parse_date, metavar='DATE',
+                            help='Convert only items posted before DATE')
+    arg_parser.add_argument('--ids', type=parse_ids, metavar='ID,...',
+                            help='Convert only the items with these wp_ids')
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='Continue an interrupted run, without converting '
+                                 'the items it already wrote again')
+    arg_parser.add_argument('--plan', nargs='?', const='', metavar='FILE',
+                            help='Only report what a run would convert, skip, '
+                                 'download and name, without converting, '
+                                 'downloading or writing anything; the report is '
+                                 'also written to FILE as JSON')
+    arg_parser.add_argument('--retry-failed', action='store_true',
+                            help='Try image downloads that failed in earlier runs '
+                                 'again, and update the items that miss them')
+    args = arg_parser.parse_args()
+
+    config = load_config('config.yaml')
+    try:
+        check_config(config)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if args.plan is not None:
+        report = plan(config=config, verbose=True if args.v else None, shard=args.shard,
+                      since=args.since, until=args.until, ids=args.ids)
+        print_plan(report)
+        if args.plan:
+            save_json(args.plan, report)
+        return
+
+    print('starting..')
+    jobs = args.jobs or os.cpu_count() or 1
+    convert(config=config, force=args.force, jobs=jobs,
+            verbose=True if args.v else None,
+            slowest=10 if args.profile is None else args.profile,
+            shard=args.shard, since=args.since, until=args.until, ids=args.ids,
+            resume=args.resume, retry_failed=args.retry_failed)
+
+    report = stats.report()
+    report['jobs'] = jobs
+    if args.profile is not None:
+        stats.print_report(report)
+    if args.stats_json:
+        save_json(args.stats_json, report)
+    print('done')
+
+
+if __name__ == '__main__':
+    main()
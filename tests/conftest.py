@@ -0,0 +1,7 @@
+import os
+import sys
+
+# exitwp.py is a script in the repository root, not an installed package
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
@@ -0,0 +1,58 @@
+import random
+import re
+
+import pytest
+
+import exitwp
+
+# Random patterns like '[[' are valid but warned about
+pytestmark = pytest.mark.filterwarnings('ignore::FutureWarning')
+
+# A small alphabet, so rules and bodies overlap often; it includes the
+# regex syntax characters and backslashes that decide how a rule is run
+ALPHABET = 'aab\\.*[](){}+?^$|-n'
+BODY_ALPHABET = 'aabb.*[](){}+?-\\n<>&;'
+
+
+def sequential(rules, body):
+    for key, value in rules.items():
+        body = re.sub(key, value, body)
+    return body
+
+
+def random_rule(rng):
+    if rng.random() < 0.5:
+        # Plain strings, which are merged into one pass where possible
+        key = ''.join(rng.choice('ab<>&;') for _ in range(rng.randint(0, 3)))
+        value = ''.join(rng.choice('ab<>') for _ in range(rng.randint(0, 3)))
+        return key, value
+    key = ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 4)))
+    value = ''.join(rng.choice('ab.\\1') for _ in range(rng.randint(0, 3)))
+    try:
+        re.sub(key, value, 'ab')
+    except (re.error, IndexError):
+        return None
+    return key, value
+
+
+def test_matches_sequential_re_sub():
+    rng = random.Random(7)
+    for _ in range(20000):
+        rules = dict(filter(None, (random_rule(rng) for _ in range(rng.randint(1, 5)))))
+        body = ''.join(rng.choice(BODY_ALPHABET) for _ in range(rng.randint(0, 30)))
+        assert exitwp.BodyReplacer(rules)(body) == sequential(rules, body), (rules, body)
+
+
+def test_shortcode_rules():
+    rules = {
+        r'\[caption[^\]]*\]': '',
+        r'\[/caption\]': '',
+        r'\[python\]': '{{< highlight python >}}',
+        r'\[/python\]': '{{< /highlight >}}',
+        '<pre.*?lang="(.*?)".*?>': r'<pre><code class="language-\1">',
+        '&nbsp;': ' ',
+        'nbsp': 'x',
+    }
+    body = ('[caption id="1"]<img src="a.jpg">[/caption]&nbsp;[python]x = 1[/python]'
+            '<pre class="a" lang="go">nbsp</pre>')
+    assert exitwp.BodyReplacer(rules)(body) == sequential(rules, body)
@@ -0,0 +1,47 @@
+import os
+
+import yaml
+
+import exitwp
+from conftest import REPO_DIR
+
+EXPORT = '''<?xml version="1.0" encoding="UTF-8" ?>
+<rss version="2.0"
+    xmlns:content="http://purl.org/rss/1.0/modules/content/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:wp="http://wordpress.org/export/1.2/">
+<channel>
+    <title>Empty</title>
+    <link>http://myoldblog.com</link>
+    <item>
+        <title>Nothing to say</title>
+        <link>http://myoldblog.com/nothing/</link>
+        <dc:creator>admin</dc:creator>
+        <guid isPermaLink="false">http://myoldblog.com/?p=1</guid>
+        <content:encoded></content:encoded>
+        <wp:post_id>1</wp:post_id>
+        <wp:post_date>2020-01-01 12:00:00</wp:post_date>
+        <wp:post_date_gmt>2020-01-01 11:00:00</wp:post_date_gmt>
+        <wp:post_name>nothing</wp:post_name>
+        <wp:status>publish</wp:status>
+        <wp:post_parent>0</wp:post_parent>
+        <wp:post_type>post</wp:post_type>
+    </item>
+</channel>
+</rss>
+'''
+
+
+def test_item_without_body(tmp_path):
+    with open(tmp_path / 'empty.xml', 'w', encoding='utf-8') as f:
+        f.write(EXPORT)
+    config = exitwp.load_config(os.path.join(REPO_DIR, 'config.yaml'))
+    config.update(build_dir=str(tmp_path / 'build'), download_images=False)
+    results = exitwp.convert(str(tmp_path / 'empty.xml'), config)
+    assert [result['status'] for result in results] == ['written']
+    with open(results[0]['file'], 'r', encoding='utf-8') as f:
+        header = f.read().split('---\n')[1]
+    assert yaml.safe_load(header)['title'] == 'Nothing to say'
+    # Converted again, from the conversion cache
+    results = exitwp.convert(str(tmp_path / 'empty.xml'), config, force=True)
+    assert [result['status'] for result in results] == ['identical']
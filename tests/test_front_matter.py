@@ -0,0 +1,45 @@
+import random
+from datetime import datetime
+
+import yaml
+
+import exitwp
+
+# Characters that need care in YAML: indicators, quotes, escapes, line
+# breaks, characters YAML folds or does not allow, and some outside the
+# Basic Multilingual Plane
+ALPHABET = ('abcXYZ019 _-./:#&*!|>\'"%@`,?[]{}\\\t\n\r' '\x00\x07\x1b\x7f\x85\xa0'
+            '  ﻿￾￿é€中😀')
+RESERVED = ['y', 'Yes', 'no', 'ON', 'off', 'true', 'False', 'null', '~', '', ' ',
+            '1', '0x1f', '1e3', '.inf', '-.NaN', '2020-01-01', '12:30', '- a', '? x']
+
+
+def random_strings(count, seed=1):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 12)))
+
+
+def test_scalars_round_trip():
+    for value in RESERVED + list(random_strings(5000)):
+        text = exitwp.toyaml({'title': value, 'tags': [value, 'plain']})
+        assert yaml.safe_load(text) == {'title': value, 'tags': [value, 'plain']}, text
+
+
+def test_dates_and_empty_lists():
+    date = datetime(2020, 1, 2, 3, 4, 5, tzinfo=exitwp.CET())
+    loaded = yaml.safe_load(exitwp.toyaml({'date': date, 'tags': [], 'url': None}))
+    assert loaded == {'date': date, 'tags': [], 'url': None}
+
+
+def test_output_does_not_depend_on_libyaml(monkeypatch):
+    data = {'title': 'on 😀', 'url': '/a/b/', 'tags': ['yes', 'x: y']}
+    with_libyaml = exitwp.toyaml(data)
+    monkeypatch.setattr(exitwp, 'yaml_dumper', lambda: yaml.SafeDumper)
+    assert exitwp.toyaml(data) == with_libyaml
+    assert '😀' in with_libyaml
+
+
+def test_other_types_fall_back_to_pyyaml():
+    assert yaml.safe_load(exitwp.toyaml({'weight': 3, 'params': {'a': [1]}})) == {
+        'weight': 3, 'params': {'a': [1]}}
@@ -0,0 +1,147 @@
+import functools
+import os
+import subprocess
+import sys
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yaml
+
+from conftest import REPO_DIR
+
+PIL = pytest.importorskip('PIL')
+from PIL import Image
+
+EXPORT = '''<?xml version="1.0" encoding="UTF-8" ?>
+<rss version="2.0"
+    xmlns:content="http://purl.org/rss/1.0/modules/content/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:wp="http://wordpress.org/export/1.2/">
+<channel>
+    <title>Images</title>
+    <link>{blog}</link>
+{items}
+</channel>
+</rss>
+'''
+
+ITEM = '''    <item>
+        <title>{type} {wp_id}</title>
+        <link>{blog}/{type}-{wp_id}/</link>
+        <dc:creator>admin</dc:creator>
+        <guid isPermaLink="false">{blog}/?p={wp_id}</guid>
+        <content:encoded><![CDATA[<p>Text</p>{body}]]></content:encoded>
+        <wp:post_id>{wp_id}</wp:post_id>
+        <wp:post_date>2020-01-0{wp_id} 12:00:00</wp:post_date>
+        <wp:post_date_gmt>2020-01-0{wp_id} 12:00:00</wp:post_date_gmt>
+        <wp:post_name>{type}-{wp_id}</wp:post_name>
+        <wp:status>publish</wp:status>
+        <wp:post_parent>0</wp:post_parent>
+        <wp:post_type>{type}</wp:post_type>
+    </item>
+'''
+
+
+@pytest.fixture
+def image_server(tmp_path):
+    """Serves the blog's uploads over HTTP, a 3000x2000 JPEG, and yields
+    the URL of the blog."""
+    root = tmp_path / 'www'
+    (root / 'wp-content' / 'uploads').mkdir(parents=True)
+    Image.new('RGB', (3000, 2000), 'teal').save(
+        root / 'wp-content' / 'uploads' / 'shared.jpg', 'JPEG')
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(root))
+    handler.log_message = lambda *args: None
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def image_tag(blog):
+    return f'<img src="{blog}/wp-content/uploads/shared.jpg" />'
+
+
+def upload_link(blog):
+    return f'<a href="{blog}/wp-content/uploads/shared.jpg">Full size</a>'
+
+
+def convert(tmp_path, blog, items, optimize=False):
+    exports = tmp_path / 'exports'
+    exports.mkdir(exist_ok=True)
+    with open(exports / 'images.xml', 'w', encoding='utf-8') as f:
+        f.write(EXPORT.format(blog=blog, items=''.join(
+            ITEM.format(blog=blog, **item) for item in items)))
+    with open(os.path.join(REPO_DIR, 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    config.update(wp_exports=str(exports), build_dir=str(tmp_path / 'build'),
+                  download_images=True, target_format='html', body_replace={})
+    config['image_settings'].update(
+        included_domains=[], excluded_url_parts=[], default_image_validity=True,
+        cache_dir=str(tmp_path / 'cache'),
+        optimize={'enabled': optimize, 'srcset_widths': [800]})
+    with open(tmp_path / 'config.yaml', 'w') as f:
+        yaml.safe_dump(config, f)
+    # A hang is the bug this guards against, so it must not hang the tests
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'exitwp.py')],
+                   cwd=tmp_path, check=True, stdout=subprocess.DEVNULL, timeout=120)
+    return tmp_path / 'build' / 'hugo' / os.listdir(tmp_path / 'build' / 'hugo')[0]
+
+
+def image_files(blog_dir):
+    return sorted(os.path.relpath(os.path.join(dirpath, filename), blog_dir / 'images')
+                  for dirpath, _, filenames in os.walk(blog_dir / 'images')
+                  for filename in filenames)
+
+
+def test_shared_image_is_optimized_for_every_item(tmp_path, image_server):
+    items = [{'type': 'page', 'wp_id': 1, 'body': image_tag(image_server)},
+             {'type': 'page', 'wp_id': 2, 'body': image_tag(image_server)},
+             {'type': 'post', 'wp_id': 3, 'body': image_tag(image_server)}]
+    blog_dir = convert(tmp_path, image_server, items, optimize=True)
+    files = image_files(blog_dir)
+    assert files == ['page-1/shared-800w.webp', 'page-1/shared.webp',
+                     'page-2/shared-800w.webp', 'page-2/shared.webp',
+                     'posts/shared-800w.webp', 'posts/shared.webp']
+    for name in files:
+        with Image.open(blog_dir / 'images' / name) as image:
+            assert image.format == 'WEBP'
+            assert image.width == (800 if name.endswith('-800w.webp') else 1920)
+
+
+def test_switching_optimize_remakes_existing_images(tmp_path, image_server):
+    items = [{'type': 'post', 'wp_id': 1, 'body': image_tag(image_server)}]
+    blog_dir = convert(tmp_path, image_server, items)
+    assert image_files(blog_dir) == ['posts/shared.jpg']
+
+    blog_dir = convert(tmp_path, image_server, items, optimize=True)
+    assert image_files(blog_dir) == ['posts/shared-800w.webp', 'posts/shared.webp']
+    with open(blog_dir / 'posts' / '2020-01-01-post-1.html', encoding='utf-8') as f:
+        assert 'src="/images/posts/shared.webp"' in f.read()
+    with Image.open(blog_dir / 'images' / 'posts' / 'shared.webp') as image:
+        assert image.width == 1920
+
+    blog_dir = convert(tmp_path, image_server, items)
+    assert 'posts/shared.jpg' in image_files(blog_dir)
+    assert 'posts/shared.webp' not in image_files(blog_dir)
+    with Image.open(blog_dir / 'images' / 'posts' / 'shared.jpg') as image:
+        assert image.width == 3000
+
+
+def test_link_to_image_of_later_item_is_resolved(tmp_path, image_server):
+    items = [{'type': 'post', 'wp_id': 1, 'body': upload_link(image_server)},
+             {'type': 'post', 'wp_id': 2, 'body': image_tag(image_server)}]
+    blog_dir = convert(tmp_path, image_server, items)
+    post = blog_dir / 'posts' / '2020-01-01-post-1.html'
+    with open(post, encoding='utf-8') as f:
+        first = f.read()
+    assert 'href="/images/posts/shared.jpg"' in first
+    with open(tmp_path / 'build' / 'unresolved-links.json', encoding='utf-8') as f:
+        assert 'shared.jpg' not in f.read()
+
+    convert(tmp_path, image_server, items)
+    with open(post, encoding='utf-8') as f:
+        assert f.read() == first
@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import yaml
+
+from generate_wxr import Generator
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    """Two exports of different blogs, and a configuration without image
+    downloads."""
+    exports = tmp_path / 'exports'
+    exports.mkdir()
+    for name, link, seed in (('a.xml', 'http://myoldblog.com', 1),
+                             ('b.xml', 'http://otherblog.org', 2)):
+        generator = Generator(posts=60, pages=15, comments=3, body_size=1500, link=link,
+                              image_host='http://images.mysite.com', seed=seed)
+        with open(exports / name, 'w', encoding='utf-8') as f:
+            generator.write(f)
+    with open(os.path.join(REPO_DIR, 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    config.update(wp_exports=str(exports), download_images=False,
+                  body_replace={r'\[caption[^\]]*\]': '', '&nbsp;': ' '})
+    with open(tmp_path / 'config.yaml', 'w') as f:
+        yaml.safe_dump(config, f)
+    return tmp_path
+
+
+def run(workspace, build_dir, *args):
+    with open(workspace / 'config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+    config['build_dir'] = str(workspace / build_dir)
+    with open(workspace / 'config.yaml', 'w') as f:
+        yaml.safe_dump(config, f)
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'exitwp.py'), *args],
+                   cwd=workspace, check=True, stdout=subprocess.DEVNULL)
+    return workspace / build_dir / 'hugo'
+
+
+def read_tree(root):
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def test_jobs_output_matches_serial(workspace):
+    serial = read_tree(run(workspace, 'serial'))
+    assert len(serial) > 100
+    assert read_tree(run(workspace, 'parallel', '--jobs', '3')) == serial
+
+
+def test_shards_combine_to_full_run(workspace):
+    full = read_tree(run(workspace, 'full'))
+    combined = {}
+    for k in (1, 2, 3):
+        shard = read_tree(run(workspace, f'shard{k}', '--shard', f'{k}/3'))
+        assert shard and len(shard) < len(full)
+        # No file is written by two shards
+        assert not set(shard) & set(combined)
+        combined.update(shard)
+    assert combined == full
+
+
+def test_exports_reusing_wp_ids_are_kept_apart(workspace):
+    # Two exports of the same blog whose wp_ids stand for different items
+    for name, seed in (('a.xml', 1), ('b.xml', 2)):
+        generator = Generator(posts=30, pages=10, comments=3, body_size=500,
+                              link='http://myoldblog.com', seed=seed)
+        with open(workspace / 'exports' / name, 'w', encoding='utf-8') as f:
+            generator.write(f)
+    blog_dir = run(workspace, 'build')
+    files = read_tree(blog_dir)
+    drafts = sum(open(workspace / 'exports' / name, encoding='utf-8').read()
+                 .count('<wp:status>draft</wp:status>') for name in ('a.xml', 'b.xml'))
+    assert len([name for name in files if name.endswith('.md')]) == 80 - drafts
+
+    with open(workspace / 'build' / 'build-manifest.json', 'r') as f:
+        items = json.load(f)['items']
+    assert read_tree(run(workspace, 'build')) == files
+    with open(workspace / 'build' / 'build-manifest.json', 'r') as f:
+        # Nothing was written again
+        assert json.load(f)['items'] == items